@@ -6,3 +6,10 @@ secure_scheme_headers = {'X-Forwarded-Proto': 'https'}
 max_requests = 1024
 max_requests_jitter = 256
 timeout = 60
+
+
+def worker_exit(server, worker):
+    # write buffered downloads and audit log entries before a worker
+    # is recycled
+    from idris.utils import drain_background_workers
+    drain_background_workers()
@@ -88,6 +88,13 @@ def configure(global_config, **settings):
 
     config.add_static_view('static', path='idris:static/dist/web')
 
+    config.registry['tenantless_routes'].update([
+        'liveness_check', 'readiness_check',
+        'api_without_slash', '__api/', '__static/', 'edit_without_slash'])
+    config.registry['replica_routes'].update([
+        'WorkListing', 'WorkSearch', 'PersonSearch', 'GroupSearch',
+        'WorkBulk', 'PersonBulk', 'GroupBulk'])
+
 
     config.add_route('edit_without_slash', '/edit')
     config.add_view(
@@ -11,6 +11,8 @@ def includeme(config):
     config.registry.registerUtility(
         CourseAppRoot, IAppRoot, 'course')
     config.scan('idris.apps.course.views')
+    config.registry['replica_routes'].update(['Course', 'collection_Course'])
+    config.registry['audit_logs'].add('usage')
     config.registry.registerUtility(
         ProCourseRoyaltyCalculator2017, ICourseRoyaltyCalculator, '2017')
     config.registry.registerUtility(
@@ -433,10 +433,7 @@ class CourseRecordAPI(object):
             cache_key = 'course-simple:%s@%s' % (
                 self.context.model.id, self.context.model.revision)
 
-        result = self.request.repository.cache.get(cache_key)
-        if result:
-            result = json.loads(result)
-        else:
+        def render_course():
             toc_items =  self.context.toc_items_csl()
             if qs['show_royalties']:
                 course_year = str(self.context.model.issued.year)
@@ -449,20 +446,25 @@ class CourseRecordAPI(object):
                     toc_items.get(
                         royalty_calculation['id'],
                         {})['royalties'] = royalty_calculation
-            result = CourseSchema().to_json(
+            return CourseSchema().to_json(
                 {'course': self.context.to_course_data(),
                  'toc_items': toc_items})
-            # cache result for one hour
-            self.request.repository.cache.set(
-                cache_key,
-                json.dumps(result).encode('utf8'),
-                60*60)
-        material_ids = result['toc_items'].keys()
+
+        # cache result for one hour, when many users open a changed course
+        # at the same time, only one of them renders it
+        result = self.request.repository.cache.get_or_compute(
+            cache_key,
+            render_course,
+            60*60)
+        material_ids = list(result['toc_items'].keys())
         download_counts = self.request.repository.downloads.get_unique_counts(
             material_ids)
+        # the cached result is shared, so add the counts to a copy
+        toc_items = {}
         for index, material_id in enumerate(material_ids):
-            count = download_counts[index]
-            result['toc_items'][material_id]['downloaded'] = count
+            toc_items[material_id] = dict(result['toc_items'][material_id],
+                                          downloaded=download_counts[index])
+        result = dict(result, toc_items=toc_items)
 
         self.response.content_type =  'application/json'
         self.response.write(json.dumps(result).encode('utf8'))
@@ -6,14 +6,23 @@ import hashlib
 import subprocess
 import tempfile
 import base64
+import logging
 
+import rq
+import redis
+from sqlalchemy import event
 from pyramid.httpexceptions import HTTPFound
+from pyramid.exceptions import ConfigurationError
+from pyramid.response import FileResponse, Response
+from webob.static import FileIter
 
 from zope.interface import implementer
 from google.cloud import storage
 from google.auth import app_engine
 
 from idris.interfaces import IBlobStoreBackend, IBlobTransform
+from idris.exceptions import StorageError
+from idris.models import Blob
 
 
 class BlobStore(object):
@@ -62,17 +71,89 @@ class BlobStore(object):
             os.remove(local_blob_path)
 
         blob.model.transform_name = transformer.name
+        blob.model.transform_status = 'done'
+
+    def queue_transform(self, blob):
+        """Queue the transform and finalization of a blob as a background
+        job, once the current transaction is committed. Returns False
+        if there is no transform queue, or nothing to transform"""
+        queue = self.registry.get('transform_queue')
+        if queue is None:
+            return False
+        if self.registry.queryUtility(IBlobTransform,
+                                      blob.model.format) is None:
+            return False
+        repository = self.backend.repository
+        blob_id = blob.model.id
+        blob.model.transform_status = 'queued'
+        blob.put()
+
+        def enqueue(session):
+            try:
+                queue.enqueue('idris.tools.transform_blob_job',
+                              repository.namespace,
+                              repository.api_host_url,
+                              repository.app_name,
+                              blob_id)
+            except Exception as err:
+                # the blob is committed as queued, without a job
+                logging.error('Queueing transform of blob %s failed: %s' % (
+                    blob_id, err))
+                self.set_transform_status(blob_id, 'failed')
+
+        event.listen(repository.session, 'after_commit', enqueue, once=True)
+        return True
+
+    def set_transform_status(self, blob_id, status):
+        """Update the transform status of a blob outside of the request
+        transaction, which is already committed"""
+        engine = self.registry['engine']
+        with engine.begin() as connection:
+            connection.execute('SET LOCAL search_path TO %s, public' % (
+                self.backend.repository.namespace))
+            connection.execute(Blob.__table__.update().where(
+                Blob.id == blob_id).values(transform_status=status))
+
+
+class BlobFileResponse(FileResponse):
+    """A FileResponse that is served with wsgi.file_wrapper when the server
+    provides it, so the bytes can be sent with sendfile. Byte range requests
+    are answered with a 206 response that reads only the requested range.
+    """
+
+    def __init__(self, path, request=None, **kwargs):
+        super(BlobFileResponse, self).__init__(
+            path, request=request, **kwargs)
+        self.path = path
+        self.accept_ranges = 'bytes'
+
+    def app_iter_range(self, start, stop):
+        close = getattr(self.app_iter, 'close', None)
+        if close is not None:
+            close()
+        return FileIter(open(self.path, 'rb')).app_iter_range(
+            seek=start, limit=stop)
 
 
 @implementer(IBlobStoreBackend)
 class LocalBlobStore(object):
     remote_storage = False
+    chunk_size = 64 * 1024
+    # the content of a finalized blob never changes, but access to blobs
+    # is checked on every request, previews are public
+    cache_control = 'private, no-cache'
+    preview_cache_control = 'public, max-age=31536000, immutable'
 
     def __init__(self, repo_config):
         self.repository = repo_config
+        settings = repo_config.registry.settings
         self._path = self.root_path(
-            repo_config.registry.settings['idris.blob_root_prefix'],
+            settings['idris.blob_root_prefix'],
             self.repository.namespace)
+        self._root = self.root_path(settings['idris.blob_root_prefix'], '')
+        self.delivery = settings.get('idris.blob_delivery', 'direct')
+        self.internal_location = settings.get(
+            'idris.blob_internal_location', '/_blobs').rstrip('/')
 
     @classmethod
     def root_path(cls, path, namespace):
@@ -114,31 +195,100 @@ class LocalBlobStore(object):
     def local_path(self, blob_id):
         return self._blob_path(blob_id)
 
+    def _file_response(self,
+                       request,
+                       path,
+                       content_type,
+                       etag=None,
+                       cache_control=None):
+        """Returns a response for the file at path. Unless delivery is
+        'direct', the bytes are sent by the fronting web server, which
+        serves the path from the X-Accel-Redirect (nginx) or X-Sendfile
+        header. For nginx the blob root is mapped on an internal location:
+
+          location /_blobs/ {
+              internal;
+              alias /path/to/var/files/;
+          }
+
+        A request with a matching If-None-Match header is answered with
+        304 Not Modified, without opening the file.
+        """
+        if etag is not None and etag in request.if_none_match:
+            response = Response(status=304)
+        elif self.delivery == 'direct':
+            response = BlobFileResponse(path,
+                                        request=request,
+                                        content_type=content_type)
+        else:
+            response = Response(content_type=content_type)
+            if self.delivery == 'x-accel-redirect':
+                response.headers['X-Accel-Redirect'] = '%s/%s' % (
+                    self.internal_location,
+                    os.path.relpath(path, self._root).replace(os.sep, '/'))
+            else:
+                response.headers['X-Sendfile'] = os.path.abspath(path)
+        if etag is not None:
+            response.etag = etag
+        if cache_control is not None:
+            response.headers['Cache-Control'] = cache_control
+        return response
+
     def serve_preview_blob(self, request, response, blob):
-        "Modify the response to servce bytes from blob_key"
-        response.content_type = 'image/jpeg'
+        "Returns a response that streams the preview of the blob"
         preview_kind =  blob.model.info.get('preview_blob')
         path = self._blob_path(blob.model.id, preview_kind)
-        with open(path, 'rb') as fp:
-            response.body = fp.read()
-        return response
+        etag = None
+        if blob.model.checksum:
+            etag = '%s-%s' % (blob.model.checksum, preview_kind)
+        return self._file_response(request,
+                                   path,
+                                   'image/jpeg',
+                                   etag=etag,
+                                   cache_control=self.preview_cache_control)
 
     def serve_blob(self, request, response, blob):
-        "Modify the response to servce bytes from blob_key"
-        response.content_type = blob.model.format
+        "Returns a response that streams the bytes of the blob"
+        path = self._blob_path(blob.model.id)
+        response = self._file_response(request,
+                                       path,
+                                       blob.model.format,
+                                       etag=blob.model.checksum or None,
+                                       cache_control=self.cache_control)
         response.content_disposition = (
             'attachment; filename=%s' % blob.model.name)
-        path = self._blob_path(blob.model.id)
-        with open(path, 'rb') as fp:
-            response.body = fp.read()
         return response
 
     def receive_blob(self, request, blob):
+        """Stream the request body to disk in chunks of chunk_size bytes,
+        computing the checksum on the way. The file is written to a
+        temporary path, and only moved in place if its size matches the
+        size of the blob"""
         path = self._blob_path(str(blob.model.id),
                                makedirs=True)
-        with open(path, 'wb') as fp:
-            fp.write(request.body)
-        blob.model.checksum = hashlib.md5(request.body).hexdigest()
+        upload_path = '%s.upload' % path
+        checksum = hashlib.md5()
+        size = 0
+        body_file = request.body_file
+        try:
+            with open(upload_path, 'wb') as fp:
+                while True:
+                    chunk = body_file.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    fp.write(chunk)
+                    checksum.update(chunk)
+                    size += len(chunk)
+            if blob.model.bytes is not None and size != blob.model.bytes:
+                raise StorageError(
+                    'Expected %s bytes, received %s bytes' % (
+                        blob.model.bytes, size),
+                    location='body')
+            os.rename(upload_path, path)
+        finally:
+            if os.path.isfile(upload_path):
+                os.remove(upload_path)
+        blob.model.checksum = checksum.hexdigest()
 
     def has_transform_data(self, blob_key, transform_id):
         path = self._blob_path(str(blob_key),
@@ -361,7 +511,23 @@ class PDFTransform(object):
         return output
 
 
+BLOB_DELIVERY = ('direct', 'x-accel-redirect', 'x-sendfile')
+
+
 def includeme(config):
+    settings = config.get_settings()
+    delivery = settings.get('idris.blob_delivery', 'direct')
+    if delivery not in BLOB_DELIVERY:
+        raise ConfigurationError(
+            'Unknown idris.blob_delivery: %s' % delivery)
+    queue = None
+    if settings.get('transform_queue.url'):
+        # transforms are run by the transform_worker script
+        queue = rq.Queue(
+            settings.get('transform_queue.name', 'transforms'),
+            connection=redis.Redis.from_url(settings['transform_queue.url']),
+            default_timeout=int(settings.get('transform_queue.timeout', 180)))
+    config.registry['transform_queue'] = queue
     config.registry.registerUtility(LocalBlobStore,
                                     IBlobStoreBackend,
                                     'local')
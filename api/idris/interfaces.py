@@ -174,11 +174,30 @@ class ICacheService(Interface):
         "set a key to value with optional expiration"
         pass
 
+    def get_object(self, key):
+        "return the decoded object stored in a key"
+        pass
+
+    def set_object(self, key, value, expire=None):
+        "set a key to an object with optional expiration"
+        pass
+
+    def get_or_compute(self, key, compute, expire=None):
+        """return the object stored in a key, or store and return the result
+        of compute(), making sure only one process computes the value"""
+        pass
+
     def delete(self, key):
         "remove a key"
 
+    def key_sizes(self, limit=20):
+        "return (key, bytes) tuples of the largest stored objects"
+
+    def generation(self):
+        "return the generation of the keys, which changes on a flush"
+
     def flush(self):
-        "remove all keys (for this namespace), returns number of keys removed"
+        "invalidate all keys (for this namespace)"
 
 class IDownloadCounter(Interface):
     def __init__(self, connection_uri, namespace, timezone):
@@ -238,8 +257,26 @@ class IAuditLogService(Interface):
         "write entry to the log, returns true if successful"
         pass
 
-    def work_history(work_id):
-        "retrieve all log entries for a work, (list of dicts)"
+    def work_history(log_name,
+                     work_id,
+                     limit=None,
+                     before=None,
+                     actions=None,
+                     start=None,
+                     end=None):
+        """retrieve log entries for a work, newest first (iterator of dicts)
+        the (created, id) of the last entry of a page can be passed as
+        `before` to retrieve the next page"""
+        pass
+
+    def work_history_summary(log_name,
+                             work_id,
+                             actions=None,
+                             start=None,
+                             end=None,
+                             period='day'):
+        """retrieve the number of log entries and unique users of a work
+        per day, month or year (iterator of dicts)"""
         pass
 
     def count_entries(self, group_by_columns, count_column, distinct=True):
@@ -102,6 +102,8 @@ class Blob(Base):
     text = Column(UnicodeText)
     search_terms = Column(TSVECTOR)
     finalized = Column(Boolean)
+    # queued, running, done or failed
+    transform_status = Column(Unicode(16))
 
     def to_dict(self):
         result = {'id': self.id,
@@ -112,7 +114,8 @@ class Blob(Base):
                   'info': self.info,
                   'text': self.text,
                   'finalized': self.finalized,
-                  'transform_name': self.transform_name}
+                  'transform_name': self.transform_name,
+                  'transform_status': self.transform_status}
         return result
 
     def update_dict(self, data):
@@ -1382,6 +1385,34 @@ class Affiliation(Base):
         return affiliation
 
 
+class DownloadStats(Base):
+    """Daily download counts rolled up from the download counter, a row
+    without a work_id holds the counts of the whole repository.
+    """
+    __tablename__ = 'download_stats'
+    __table_args__ = (Index('ix_download_stats_date_work_id',
+                            'date',
+                            'work_id'),)
+    id = Column(Integer, Sequence('download_stats_id_seq'), primary_key=True)
+    work_id = Column(BigInteger, index=True, nullable=True)
+    date = Column(Date, nullable=False)
+    total = Column(Integer, nullable=False, default=0)
+    unique = Column(Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {'work_id': self.work_id,
+                'date': self.date.isoformat(),
+                'total': self.total,
+                'unique': self.unique}
+
+
+# a single row per work (or repository) and day, rolled up with upserts
+Index('ix_download_stats_work_id_date',
+      func.coalesce(DownloadStats.__table__.c.work_id, 0),
+      DownloadStats.__table__.c.date,
+      unique=True)
+
+
 class Repository(Base):
     __tablename__ = 'repositories'
     namespace = Column(Unicode(32), primary_key=True)
@@ -0,0 +1,317 @@
+import time
+import threading
+
+import redis
+from pyramid.settings import asbool
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+class MeteredQueuePool(QueuePool):
+    """A QueuePool that keeps track of checkouts that had to wait for
+    a connection to become available, and of checkouts that timed out.
+    """
+
+    # the TenantBudget shared by the pools of all tenants, and the
+    # namespace of the tenant of this pool
+    budget = None
+    namespace = None
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredQueuePool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._local = threading.local()
+        self._checkouts = 0
+        self._queued = 0
+        self._waiting = 0
+        self._timeouts = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+
+    def _do_get(self):
+        if getattr(self._local, 'metering', False):
+            # QueuePool._do_get calls itself when it lost a race
+            return super(MeteredQueuePool, self)._do_get()
+        self._local.metering = True
+        try:
+            if self.budget is None:
+                return self._metered_do_get()
+            try:
+                self.budget.acquire(self.namespace, self._timeout)
+            except exc.TimeoutError:
+                with self._stats_lock:
+                    self._timeouts += 1
+                raise
+            try:
+                return self._metered_do_get()
+            except:
+                self.budget.release(self.namespace)
+                raise
+        finally:
+            self._local.metering = False
+
+    def _do_return_conn(self, conn):
+        try:
+            super(MeteredQueuePool, self)._do_return_conn(conn)
+        finally:
+            if self.budget is not None:
+                self.budget.release(self.namespace)
+
+    def recreate(self):
+        pool = super(MeteredQueuePool, self).recreate()
+        pool.budget = self.budget
+        pool.namespace = self.namespace
+        return pool
+
+    def _metered_do_get(self):
+        queued = (self._max_overflow > -1 and
+                  self._pool.empty() and
+                  self._overflow >= self._max_overflow)
+        if queued:
+            with self._stats_lock:
+                self._queued += 1
+                self._waiting += 1
+        start = time.monotonic()
+        try:
+            return super(MeteredQueuePool, self)._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - start
+            with self._stats_lock:
+                self._checkouts += 1
+                if queued:
+                    self._waiting -= 1
+                    self._wait_time += waited
+                    self._max_wait_time = max(self._max_wait_time, waited)
+
+    def stats(self):
+        "Returns a dict with the current pool numbers and wait statistics"
+        with self._stats_lock:
+            return {'size': self.size(),
+                    'max_overflow': self._max_overflow,
+                    'checked_in': self.checkedin(),
+                    'checked_out': self.checkedout(),
+                    'overflow': self.overflow(),
+                    'checkouts': self._checkouts,
+                    'queued': self._queued,
+                    'waiting': self._waiting,
+                    'timeouts': self._timeouts,
+                    'wait_time': round(self._wait_time, 3),
+                    'max_wait_time': round(self._max_wait_time, 3)}
+
+
+def pool_stats(pool):
+    "Returns pool numbers as a dict, for any kind of QueuePool"
+    if isinstance(pool, MeteredQueuePool):
+        return pool.stats()
+    return {'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow()}
+
+
+def tenant_pool_limits(settings, namespace):
+    """Returns the (min_size, max_size, timeout) of the connections of a
+    single tenant.
+
+    All tenants of a process share a budget of `total` connections, it
+    defaults to the size of the shared pool (sqlalchemy.pool_size +
+    sqlalchemy.max_overflow). Every tenant has `min_size` reserved
+    connections and can burst up to `max_size` connections, by default half
+    of the budget, so a single busy tenant can not starve the others. The
+    defaults can be overridden per namespace:
+
+      idris.tenant_pool.total = 20
+      idris.tenant_pool.min_size = 1
+      idris.tenant_pool.max_size = 6
+      idris.tenant_pool.timeout = 10
+      idris.tenant_pool.<namespace>.max_size = 12
+    """
+    def setting(name, default):
+        value = settings.get('idris.tenant_pool.%s.%s' % (namespace, name))
+        if value is None:
+            value = settings.get('idris.tenant_pool.%s' % name, default)
+        return int(value)
+
+    total = tenant_pool_total(settings)
+    min_size = min(setting('min_size', 1), total)
+    max_size = min(setting('max_size', max(total // 2, min_size)), total)
+    timeout = setting('timeout', settings.get('sqlalchemy.pool_timeout', 30))
+    return min_size, max(max_size, min_size), timeout
+
+
+def tenant_pool_total(settings):
+    "Returns the number of connections that all tenants can check out"
+    return int(settings.get(
+        'idris.tenant_pool.total',
+        int(settings.get('sqlalchemy.pool_size', 5)) +
+        int(settings.get('sqlalchemy.max_overflow', 10))))
+
+
+def tenant_pool_options(settings, namespace):
+    """Returns the engine pool arguments for the pool of a single tenant,
+    see `tenant_pool_limits`"""
+    min_size, max_size, timeout = tenant_pool_limits(settings, namespace)
+    return {'poolclass': MeteredQueuePool,
+            'pool_size': min_size,
+            'max_overflow': max_size - min_size,
+            'pool_timeout': timeout}
+
+
+class TenantBudget(object):
+    """Limits the number of connections that are checked out at the same
+    time by all tenants of a process.
+
+    Every tenant has `min_size` reserved connections that no other tenant
+    can take, the rest of the `total` is a shared burst pool. A tenant only
+    takes connections from the burst pool above its reserved minimum, and
+    never more than `max_size` connections. Reservations are made when a
+    tenant first checks out a connection, and never take the last
+    connection of the burst pool, so tenants without a reservation can
+    still get a connection.
+    """
+
+    def __init__(self, total, tenant_limits):
+        self.total = total
+        # function that returns the (min_size, max_size) of a tenant
+        self._tenant_limits = tenant_limits
+        self._limits = {}
+        self._reserved = 0
+        self._in_use = {}
+        self._checked_out = 0
+        self._burst = 0
+        self._timeouts = 0
+        self._condition = threading.Condition()
+
+    def _tenant(self, namespace):
+        limits = self._limits.get(namespace)
+        if limits is None:
+            min_size, max_size = self._tenant_limits(namespace)
+            min_size = max(min(min_size, self.total - 1 - self._reserved), 0)
+            limits = self._limits[namespace] = (min_size, max_size)
+            self._reserved += min_size
+        return limits
+
+    def _available(self, namespace):
+        min_size, max_size = self._tenant(namespace)
+        in_use = self._in_use.get(namespace, 0)
+        if self._checked_out >= self.total or in_use >= max_size:
+            return False
+        if in_use < min_size:
+            return True
+        return self._burst < self.total - self._reserved
+
+    def acquire(self, namespace, timeout):
+        "Take a connection from the budget, raises exc.TimeoutError"
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._available(namespace):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise exc.TimeoutError(
+                        'Connection budget of %s exhausted' % namespace)
+                self._condition.wait(remaining)
+            in_use = self._in_use[namespace] = (
+                self._in_use.get(namespace, 0) + 1)
+            self._checked_out += 1
+            if in_use > self._limits[namespace][0]:
+                self._burst += 1
+
+    def release(self, namespace):
+        with self._condition:
+            in_use = self._in_use[namespace]
+            if in_use > self._limits[namespace][0]:
+                self._burst -= 1
+            self._in_use[namespace] = in_use - 1
+            self._checked_out -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        "Returns a dict with the total budget and the connections in use"
+        with self._condition:
+            return {'total': self.total,
+                    'reserved': self._reserved,
+                    'in_use': self._checked_out,
+                    'burst': self._burst,
+                    'tenants': len([n for n in self._in_use.values() if n]),
+                    'timeouts': self._timeouts}
+
+
+class MeteredRedisPool(redis.BlockingConnectionPool):
+    """A bounded Redis connection pool that is shared by all Redis backed
+    services of a process. When all connections are in use, callers wait
+    up to `timeout` seconds for a connection to be released.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(MeteredRedisPool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._in_use = 0
+        self._timeouts = 0
+
+    def get_connection(self, *args, **kwargs):
+        try:
+            connection = super(MeteredRedisPool, self).get_connection(
+                *args, **kwargs)
+        except redis.ConnectionError:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+        with self._stats_lock:
+            self._checkouts += 1
+            self._in_use += 1
+        return connection
+
+    def release(self, connection):
+        with self._stats_lock:
+            self._in_use = max(self._in_use - 1, 0)
+        return super(MeteredRedisPool, self).release(connection)
+
+    def stats(self):
+        "Returns a dict with the current pool numbers"
+        with self._stats_lock:
+            return {'max_connections': self.max_connections,
+                    'created': len([c for c in self._connections if c]),
+                    'in_use': self._in_use,
+                    'checkouts': self._checkouts,
+                    'timeouts': self._timeouts}
+
+
+_redis_pool_lock = threading.Lock()
+
+
+def redis_pool(registry):
+    """Returns the Redis connection pool of the application, it is created
+    on first use from the redis server in cache.url and these settings:
+
+      cache.max_connections = 50
+      cache.pool_timeout = 20
+      cache.socket_keepalive = true
+      cache.health_check_interval = 30
+
+    Returns None if cache.url is not a redis url.
+    """
+    pool = registry.get('redis_pool')
+    if pool is not None:
+        return pool
+    settings = registry.settings
+    url = settings.get('cache.url', '')
+    if not url.startswith('redis://'):
+        return
+    with _redis_pool_lock:
+        if registry.get('redis_pool') is None:
+            registry['redis_pool'] = MeteredRedisPool.from_url(
+                url,
+                max_connections=int(
+                    settings.get('cache.max_connections', 50)),
+                timeout=int(settings.get('cache.pool_timeout', 20)),
+                socket_keepalive=asbool(
+                    settings.get('cache.socket_keepalive', True)),
+                health_check_interval=int(
+                    settings.get('cache.health_check_interval', 30)))
+    return registry['redis_pool']
@@ -1,17 +1,57 @@
+import io
+import re
+import time
+import uuid
+import queue
 import datetime
 import logging
+import threading
 
+import psycopg2
 from zope.interface import implementer
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config
 from google.cloud import bigquery
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import NotFound, Conflict
 from idris.interfaces import IAuditLogService
+from idris.utils import (BackgroundWorker,
+                         register_background_worker,
+                         drain_background_workers)
+
+# BigQuery clients by service account file, they are thread safe and
+# are shared by all repositories of a process
+BQ_CLIENTS = {}
+_bq_clients_lock = threading.Lock()
+
+# (dataset, log name) of the logs that are known to exist
+KNOWN_LOGS = set()
+
+LOG_NAME_RE = re.compile(r'^[a-z][a-z0-9_]*$')
+
+
+def bigquery_client(app_credentials):
+    client = BQ_CLIENTS.get(app_credentials)
+    if client is None:
+        with _bq_clients_lock:
+            client = BQ_CLIENTS.get(app_credentials)
+            if client is None:
+                client = bigquery.Client.from_service_account_json(
+                    app_credentials)
+                BQ_CLIENTS[app_credentials] = client
+    return client
+
 
 @implementer(IAuditLogService)
 class BQAuditLog(object):
-    def __init__(self, uri, prefix):
+    chunk_size = 1000
+    # date formats of the work history summary periods
+    periods = {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}
+
+    def __init__(self, uri, prefix, writer=None):
         self.ds_name = prefix
+        self._writer = writer
         app_credentials = uri.split('#', 1)[1]
-        self.client=bigquery.Client().from_service_account_json(app_credentials)
+        self.client = bigquery_client(app_credentials)
         self.ds_ref = self.client.dataset(self.ds_name)
         field = bigquery.SchemaField
         self.schema = [
@@ -21,15 +61,19 @@ class BQAuditLog(object):
             field('created', 'TIMESTAMP', mode='REQUIRED'),
             field('context_id', 'INTEGER'),
             field('message', 'STRING'),
-            field('value', 'STRING')
+            field('value', 'STRING'),
+            # unique row id, used as insert id and to sort the history
+            field('id', 'INTEGER')
         ]
 
     def table_ref(self, name):
         return self.ds_ref.table('%s_auditlog' % name)
 
     def has_log(self, name):
+        if (self.ds_name, name) in KNOWN_LOGS:
+            return True
         try:
-            self.client.get_table(self.table_ref(name))
+            table = self.client.get_table(self.table_ref(name))
         except NotFound:
             # make sure that the dataset exists
             try:
@@ -38,6 +82,11 @@ class BQAuditLog(object):
                 raise ValueError(
                     'Missing BigQuery dataset: %s' % self.ds_name)
             return False
+        if 'id' not in [field.name for field in table.schema]:
+            # the log was created before rows had an id
+            table.schema = list(table.schema) + [self.schema[-1]]
+            self.client.update_table(table, ['schema'])
+        KNOWN_LOGS.add((self.ds_name, name))
         return True
 
     def create_log(self, name):
@@ -45,7 +94,12 @@ class BQAuditLog(object):
         table.time_partitioning = bigquery.table.TimePartitioning(
             field='created')
         table.clustering_fields=['work_id']
-        table = self.client.create_table(table)
+        try:
+            table = self.client.create_table(table)
+        except Conflict:
+            # created by another process
+            pass
+        KNOWN_LOGS.add((self.ds_name, name))
         return True
 
     def append(self,
@@ -62,33 +116,506 @@ class BQAuditLog(object):
         if isinstance(user_id, int):
             user_id = '%s' % user_id
         created = created.strftime('%Y-%m-%dT%H:%M:%S')
-        rows = [(action, work_id, user_id, created, context_id, message, value)]
+        # a random 63 bit id, rows created in the same second can not
+        # be told apart otherwise
+        row_id = uuid.uuid4().int >> 65
+        row = (action, work_id, user_id, created, context_id, message, value,
+               row_id)
+        if self._writer is not None:
+            # the row is written in the background, the log is created
+            # by the writer if it does not exist
+            return self._writer.put(self, log_name, row)
+        return self.append_many(log_name, [row]) is True
+
+    def append_many(self, log_name, rows):
+        """Insert a list of row tuples, the last value of a row is its id.
+        Returns True if the rows were written, False if the log does not
+        exist and None if the rows were rejected"""
         try:
+            if ((self.ds_name, log_name) not in KNOWN_LOGS and
+                    not self.has_log(log_name)):
+                raise NotFound('%s_auditlog' % log_name)
             result = self.client.insert_rows(
-                self.table_ref(log_name), rows, selected_fields=self.schema)
+                self.table_ref(log_name),
+                rows,
+                selected_fields=self.schema,
+                row_ids=[str(row[-1]) for row in rows])
         except NotFound:
+            KNOWN_LOGS.discard((self.ds_name, log_name))
             logging.warning('Appending to auditlog: %s failed: no such log' % log_name)
             return False
 
         if result and result[0].get('errors'):
             logging.warning('Appending to auditlog: %s failed: %s' % (
                 log_name, result[0]['errors']))
-            return False
+            return None
         return True
 
-    def work_history(self, log_name, work_id):
-        work_id = int(work_id)
-        query = ('SELECT * FROM `%s.%s_auditlog` '
-                 'WHERE work_id = %s ORDER BY created DESC' % (
-                     self.ds_name, log_name, work_id))
-        query_job = self.client.query(query, location='EU')
-        for row in query_job:
+    def _history_filters(self, log_name, work_id, actions, start, end):
+        if not LOG_NAME_RE.match(log_name):
+            raise ValueError('Invalid audit log name: %s' % log_name)
+        param = bigquery.ScalarQueryParameter
+        where = ['work_id = @work_id']
+        params = [param('work_id', 'INT64', int(work_id))]
+        if actions:
+            where.append('action IN UNNEST(@actions)')
+            params.append(bigquery.ArrayQueryParameter(
+                'actions', 'STRING', list(actions)))
+        if start is not None:
+            where.append('created >= @start')
+            params.append(param('start', 'TIMESTAMP', start))
+        if end is not None:
+            where.append('created < @end')
+            params.append(param('end', 'TIMESTAMP', end))
+        return ' AND '.join(where), params
+
+    def _query(self, query, params):
+        "Run a query and yield the rows, fetched in pages of chunk_size"
+        job_config = bigquery.QueryJobConfig(query_parameters=params)
+        query_job = self.client.query(
+            query, job_config=job_config, location='EU')
+        for row in query_job.result(page_size=self.chunk_size):
             yield dict(row)
 
+    def work_history(self,
+                     log_name,
+                     work_id,
+                     limit=None,
+                     before=None,
+                     actions=None,
+                     start=None,
+                     end=None):
+        """Yields the entries of a work, newest first, optionally filtered
+        by a list of actions and a [start, end) time range.
+
+        The row id is used as tie breaker, rows that were written before
+        rows had an id use a fingerprint of the row. Pass the (created, id)
+        of the last entry as `before` to retrieve the next page"""
+        where, params = self._history_filters(
+            log_name, work_id, actions, start, end)
+        query = ('SELECT * FROM ('
+                 'SELECT * REPLACE ('
+                 'COALESCE(id, FARM_FINGERPRINT(TO_JSON_STRING(t))) AS id) '
+                 'FROM `%s.%s_auditlog` t WHERE %s)' % (
+                     self.ds_name, log_name, where))
+        if before is not None:
+            query += (' WHERE created < @before_created OR ('
+                      'created = @before_created AND id < @before_id)')
+            params.extend([
+                bigquery.ScalarQueryParameter(
+                    'before_created', 'TIMESTAMP', before[0]),
+                bigquery.ScalarQueryParameter(
+                    'before_id', 'INT64', int(before[1]))])
+        query += ' ORDER BY created DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT %s' % int(limit)
+        return self._query(query, params)
+
+    def work_history_summary(self,
+                             log_name,
+                             work_id,
+                             actions=None,
+                             start=None,
+                             end=None,
+                             period='day'):
+        """Yields the number of entries and of unique users of a work per
+        period ('day', 'month' or 'year'), oldest first"""
+        if period not in self.periods:
+            raise ValueError('Unknown period: %s' % period)
+        where, params = self._history_filters(
+            log_name, work_id, actions, start, end)
+        query = ('SELECT FORMAT_TIMESTAMP("%s", created) AS period, '
+                 'COUNT(*) AS total, COUNT(DISTINCT user_id) AS users '
+                 'FROM `%s.%s_auditlog` WHERE %s '
+                 'GROUP BY period ORDER BY period' % (
+                     self.periods[period], self.ds_name, log_name, where))
+        for row in self._query(query, params):
+            yield {'period': row['period'],
+                   'total': row['total'],
+                   'unique': row['users']}
+
+
+# partitions that are known to exist, so they are only created once
+KNOWN_PARTITIONS = set()
+
+
+@implementer(IAuditLogService)
+class PGAuditLog(object):
+    """Audit log stored in PostgreSQL, in the schema of the repository.
+
+    Every log is an append-only table partitioned by month on the created
+    column, with a (work_id, created, id) index for the work history.
+    Rows are inserted with COPY.
+    """
+    columns = ('action', 'work_id', 'user_id', 'created',
+               'context_id', 'message', 'value')
+    chunk_size = 1000
+    # date formats of the work history summary periods
+    periods = {'day': 'YYYY-MM-DD', 'month': 'YYYY-MM', 'year': 'YYYY'}
+
+    def __init__(self, uri, prefix, writer=None, namespace=None, engine=None):
+        self.ds_name = prefix
+        self.namespace = namespace
+        self.engine = engine
+        self._writer = writer
+
+    def table_name(self, name):
+        if not LOG_NAME_RE.match(name):
+            raise ValueError('Invalid audit log name: %s' % name)
+        return '"%s"."%s_auditlog"' % (self.namespace, name)
+
+    def _partition(self, name, month):
+        "Returns the name and the date range of a monthly partition"
+        start = month.replace(day=1)
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        partition = '"%s"."%s_auditlog_%s"' % (
+            self.namespace, name, start.strftime('y%Ym%m'))
+        return partition, start, end
+
+    def _execute(self, statement, params=None):
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(statement, params)
+            result = None
+            if cursor.description is not None:
+                result = cursor.fetchall()
+            connection.commit()
+            return result
+        finally:
+            connection.close()
+
+    def _partitioned(self):
+        """Logs are partitioned by month on PostgreSQL 11 and newer, older
+        servers do not support indexes on partitioned tables"""
+        version = self.engine.dialect.server_version_info
+        if version is None:
+            # the version is known after the first connection
+            self.engine.connect().close()
+            version = self.engine.dialect.server_version_info
+        return version >= (11,)
+
+    def has_log(self, name):
+        result = self._execute('SELECT to_regclass(%s)',
+                               (self.table_name(name),))
+        return result[0][0] is not None
+
+    def create_log(self, name):
+        table = self.table_name(name)
+        partitioned = ''
+        if self._partitioned():
+            partitioned = ' PARTITION BY RANGE (created)'
+        # the schema is missing when the log is stored in a separate database
+        self._execute('CREATE SCHEMA IF NOT EXISTS "%s"' % self.namespace)
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            ' id BIGSERIAL NOT NULL,'
+            ' action TEXT NOT NULL,'
+            ' work_id BIGINT NOT NULL,'
+            ' user_id TEXT NOT NULL,'
+            ' created TIMESTAMP NOT NULL,'
+            ' context_id BIGINT,'
+            ' message TEXT,'
+            ' value TEXT'
+            ')%s' % (table, partitioned))
+        self._execute(
+            'CREATE INDEX IF NOT EXISTS "%s_auditlog_work_id_created" '
+            'ON %s (work_id, created DESC, id DESC)' % (name, table))
+        return True
+
+    def _create_partitions(self, name, rows):
+        if not self._partitioned():
+            return True
+        months = set(row[3][:7] for row in rows)
+        for month in sorted(months):
+            partition, start, end = self._partition(
+                name, datetime.datetime.strptime(month, '%Y-%m').date())
+            if partition in KNOWN_PARTITIONS:
+                continue
+            try:
+                self._execute(
+                    'CREATE TABLE IF NOT EXISTS %s PARTITION OF %s '
+                    'FOR VALUES FROM (%%s) TO (%%s)' % (
+                        partition, self.table_name(name)),
+                    (start, end))
+            except psycopg2.errors.UndefinedTable:
+                return False
+            except psycopg2.errors.DuplicateTable:
+                # created by another process
+                pass
+            KNOWN_PARTITIONS.add(partition)
+        return True
+
+    def append(self,
+               log_name,
+               action,
+               work_id,
+               user_id,
+               context_id=None,
+               message=None,
+               created=None,
+               value=None):
+        if created is None:
+            created = datetime.datetime.utcnow()
+        if isinstance(user_id, int):
+            user_id = '%s' % user_id
+        created = created.strftime('%Y-%m-%dT%H:%M:%S')
+        row = (action, work_id, user_id, created, context_id, message, value)
+        if self._writer is not None:
+            return self._writer.put(self, log_name, row)
+        return self.append_many(log_name, [row]) is True
+
+    def append_many(self, log_name, rows, retry=True):
+        """Insert a list of row tuples with COPY. Returns True if the rows
+        were written, False if the log does not exist and None if the rows
+        were rejected"""
+        if not self._create_partitions(log_name, rows):
+            logging.warning(
+                'Appending to auditlog: %s failed: no such log' % log_name)
+            return False
+        data = io.StringIO()
+        for row in rows:
+            # in CSV format an unquoted empty value is NULL
+            data.write(','.join(
+                '' if v is None else '"%s"' % str(v).replace('"', '""')
+                for v in row))
+            data.write('\n')
+        data.seek(0)
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.copy_expert('COPY %s (%s) FROM STDIN WITH CSV' % (
+                self.table_name(log_name), ', '.join(self.columns)), data)
+            connection.commit()
+        except psycopg2.errors.UndefinedTable:
+            connection.rollback()
+            logging.warning(
+                'Appending to auditlog: %s failed: no such log' % log_name)
+            return False
+        except psycopg2.errors.CheckViolation:
+            connection.rollback()
+            if not retry:
+                raise
+            # the log was dropped and created again, forget its partitions
+            prefix = '"%s"."%s_auditlog_' % (self.namespace, log_name)
+            KNOWN_PARTITIONS.difference_update(
+                [p for p in KNOWN_PARTITIONS if p.startswith(prefix)])
+            return self.append_many(log_name, rows, retry=False)
+        except psycopg2.DataError as err:
+            connection.rollback()
+            logging.warning('Appending to auditlog: %s failed: %s' % (
+                log_name, err))
+            return None
+        finally:
+            connection.close()
+        return True
+
+    def _stream(self, statement, params=None):
+        """Yields the rows of a query from a server side cursor, fetched
+        in chunks of chunk_size rows"""
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor(name='auditlog_%s' % uuid.uuid4().hex)
+            cursor.itersize = self.chunk_size
+            cursor.execute(statement, params)
+            for row in cursor:
+                yield row
+            cursor.close()
+        finally:
+            connection.close()
+
+    def _history_filters(self, log_name, work_id, actions, start, end):
+        where = ['work_id = %s']
+        params = [int(work_id)]
+        if actions:
+            where.append('action = ANY(%s)')
+            params.append(list(actions))
+        if start is not None:
+            where.append('created >= %s')
+            params.append(start)
+        if end is not None:
+            where.append('created < %s')
+            params.append(end)
+        return ' AND '.join(where), params
+
+    def work_history(self,
+                     log_name,
+                     work_id,
+                     limit=None,
+                     before=None,
+                     actions=None,
+                     start=None,
+                     end=None):
+        """Yields the entries of a work, newest first, optionally filtered
+        by a list of actions and a [start, end) time range. Pass the
+        (created, id) of the last entry as `before` to retrieve the next
+        page"""
+        where, params = self._history_filters(
+            log_name, work_id, actions, start, end)
+        query = ('SELECT id, action, work_id, user_id, created, context_id, '
+                 'message, value FROM %s WHERE %s' % (
+                     self.table_name(log_name), where))
+        if before is not None:
+            query += ' AND (created, id) < (%s, %s)'
+            params.extend(before)
+        query += ' ORDER BY created DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT %s'
+            params.append(int(limit))
+        columns = ('id', ) + self.columns
+        for row in self._stream(query, params):
+            yield dict(zip(columns, row))
+
+    def work_history_summary(self,
+                             log_name,
+                             work_id,
+                             actions=None,
+                             start=None,
+                             end=None,
+                             period='day'):
+        """Yields the number of entries and of unique users of a work per
+        period ('day', 'month' or 'year'), oldest first"""
+        if period not in self.periods:
+            raise ValueError('Unknown period: %s' % period)
+        where, params = self._history_filters(
+            log_name, work_id, actions, start, end)
+        query = ("SELECT to_char(date_trunc('%s', created), '%s') AS period, "
+                 "count(*), count(DISTINCT user_id) FROM %s WHERE %s "
+                 "GROUP BY 1 ORDER BY 1" % (
+                     period,
+                     self.periods[period],
+                     self.table_name(log_name),
+                     where))
+        for period, total, unique in self._stream(query, params):
+            yield {'period': period, 'total': total, 'unique': unique}
+
+
+class AuditLogWriter(BackgroundWorker):
+    """Writes audit log entries from a background thread.
+
+    Entries are queued in a bounded queue and written in batches per log,
+    as soon as `batch_size` entries are collected or the oldest entry is
+    `max_age` seconds old. Failed writes are retried with an exponential
+    backoff, missing logs are created.
+    """
+
+    thread_name = 'auditlog-writer'
+
+    def __init__(self,
+                 queue_size=10000,
+                 batch_size=500,
+                 max_age=1.0,
+                 max_retries=5,
+                 retry_delay=0.5):
+        super(AuditLogWriter, self).__init__()
+        self.batch_size = batch_size
+        self.max_age = max_age
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batches = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def put(self, log, log_name, row):
+        "Queue a row, returns False if the queue is full"
+        self.start()
+        try:
+            self._queue.put_nowait((log, log_name, row))
+        except queue.Full:
+            logging.warning(
+                'Audit log queue is full, dropping entry for %s' % log_name)
+            return False
+        return True
+
+    def _collect(self, timeout=None):
+        "Move queued rows into the batches"
+        while True:
+            try:
+                if timeout is None:
+                    log, log_name, row = self._queue.get_nowait()
+                else:
+                    log, log_name, row = self._queue.get(timeout=timeout)
+                    timeout = None
+            except queue.Empty:
+                return
+            with self._lock:
+                batch = self._batches.setdefault(
+                    (log.ds_name, log_name),
+                    {'log': log, 'rows': [], 'created': time.monotonic()})
+                batch['rows'].append(row)
+
+    def run(self):
+        while True:
+            self._collect(timeout=self.max_age / 2)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Writing audit log entries failed')
+
+    def flush(self, force=False):
+        """Write the batches that are full or old enough, or all batches
+        when force is True. Returns the number of rows written"""
+        now = time.monotonic()
+        with self._flush_lock:
+            with self._lock:
+                ready = [
+                    key for key, batch in self._batches.items()
+                    if force or
+                    len(batch['rows']) >= self.batch_size or
+                    now - batch['created'] >= self.max_age]
+                batches = [(key[1], self._batches.pop(key)) for key in ready]
+            written = 0
+            for log_name, batch in batches:
+                rows = batch['rows']
+                for start in range(0, len(rows), self.batch_size):
+                    chunk = rows[start:start + self.batch_size]
+                    if self._write(batch['log'], log_name, chunk):
+                        written += len(chunk)
+            return written
+
+    def _write(self, log, log_name, rows):
+        delay = self.retry_delay
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = log.append_many(log_name, rows)
+                if result is True:
+                    return True
+                elif result is None:
+                    # the rows were rejected, retrying will not help
+                    return False
+                elif not log.has_log(log_name):
+                    log.create_log(log_name)
+                    continue
+            except Exception as err:
+                logging.warning(
+                    'Writing %s rows to audit log %s failed: %s' % (
+                        len(rows), log_name, err))
+            time.sleep(delay)
+            delay *= 2
+        logging.error('Dropped %s rows for audit log %s' % (
+            len(rows), log_name))
+        return False
+
+    def drain(self):
+        "Write all queued rows, called on shutdown"
+        self._collect()
+        return self.flush(force=True)
+
+
+def drain_auditlog_writers():
+    "Write the queued audit log entries of all applications in this process"
+    return drain_background_workers(AuditLogWriter)
+
+
 def auditlog_factory(registry, repository_namespace):
     config_url = registry.settings['auditlog.url']
     proto = config_url.split('://')[0]
-    if not 'idris.google_application_credentials' in registry.settings:
+    kwargs = {}
+    if proto == 'postgresql':
+        kwargs = dict(namespace=repository_namespace,
+                      engine=registry['auditlog_engine'])
+    elif not 'idris.google_application_credentials' in registry.settings:
         return
 
     if config_url == 'bigquery://':
@@ -98,10 +625,48 @@ def auditlog_factory(registry, repository_namespace):
     CacheImpl = registry.queryUtility(IAuditLogService, proto)
     prefix = ('%s-%s' % (registry.settings['idris.app_prefix'],
                          repository_namespace)).replace('-', '_')
-    return CacheImpl(config_url, prefix)
+    return CacheImpl(config_url,
+                     prefix,
+                     writer=registry.get('auditlog_writer'),
+                     **kwargs)
 
 
+def create_audit_logs(registry, repository_namespace):
+    """Create the audit logs in registry['audit_logs'] for a repository,
+    so they do not have to be created while handling requests"""
+    auditlog = auditlog_factory(registry, repository_namespace)
+    if auditlog is None:
+        return []
+    created = []
+    for name in sorted(registry['audit_logs']):
+        if not auditlog.has_log(name):
+            auditlog.create_log(name)
+            created.append(name)
+    return created
+
 
 def includeme(config):
     config.registry.registerUtility(
         BQAuditLog, IAuditLogService, 'bigquery')
+    config.registry.registerUtility(
+        PGAuditLog, IAuditLogService, 'postgresql')
+    # names of the audit logs that are created with a repository
+    config.registry['audit_logs'] = set()
+    settings = config.get_settings()
+    auditlog_url = settings.get('auditlog.url', '')
+    if auditlog_url == 'postgresql://':
+        # store the audit log in the repository database
+        config.registry['auditlog_engine'] = config.registry['engine']
+    elif auditlog_url.startswith('postgresql://'):
+        config.registry['auditlog_engine'] = engine_from_config(
+            {'url': auditlog_url}, prefix='')
+    writer = None
+    if asbool(settings.get('auditlog.async', False)):
+        # append entries from a background thread, outside of the request
+        writer = AuditLogWriter(
+            queue_size=int(settings.get('auditlog.queue_size', 10000)),
+            batch_size=int(settings.get('auditlog.batch_size', 500)),
+            max_age=int(settings.get('auditlog.batch_age', 1000)) / 1000,
+            max_retries=int(settings.get('auditlog.max_retries', 5)))
+        register_background_worker(writer)
+    config.registry['auditlog_writer'] = writer
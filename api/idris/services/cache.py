@@ -1,43 +1,368 @@
+import json
+import time
+import uuid
+import zlib
+import threading
+
 import redis
 from zope.interface import implementer
+from pyramid.exceptions import ConfigurationError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
 
+from idris.pool import redis_pool
+from idris.utils import LRUCache
 from idris.interfaces import ICacheService
 
+# the current generation of every cache namespace, it is kept in process
+# for a short time, to save a round trip on every cache access
+GENERATIONS = LRUCache(max_size=1024, ttl=1)
+
+# only remove a lock if it is still held by the caller
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+class CacheCodec(object):
+    """Encodes cached objects with a serializer and optional compression.
+
+    Encoded values start with a header byte: the two high bits are always
+    set, bits 2-3 hold the serializer and bits 0-1 the compression. Values
+    without a header are plain JSON, as written before codecs were
+    introduced, so old and new entries can be read side by side.
+    """
+    serializers = {'json': 0, 'msgpack': 1}
+    compressions = {'none': 0, 'zlib': 1, 'lz4': 2}
+
+    def __init__(self, serializer='json', compression='none', threshold=1024):
+        if serializer not in self.serializers:
+            raise ValueError('Unknown cache serializer: %s' % serializer)
+        if compression not in self.compressions:
+            raise ValueError('Unknown cache compression: %s' % compression)
+        if serializer == 'msgpack' and msgpack is None:
+            raise ValueError('The msgpack package is not installed')
+        if compression == 'lz4' and lz4 is None:
+            raise ValueError('The lz4 package is not installed')
+        self.serializer = serializer
+        self.compression = compression
+        self.threshold = threshold
+
+    def encode(self, value):
+        if self.serializer == 'msgpack':
+            data = msgpack.packb(value, use_bin_type=True)
+        else:
+            data = json.dumps(value).encode('utf8')
+        compression = self.compression
+        if len(data) < self.threshold:
+            compression = 'none'
+        if compression == 'zlib':
+            data = zlib.compress(data)
+        elif compression == 'lz4':
+            data = lz4.compress(data)
+        header = (0xC0 |
+                  self.serializers[self.serializer] << 2 |
+                  self.compressions[compression])
+        return bytes([header]) + data
+
+    def decode(self, data):
+        if not data or data[0] & 0xC0 != 0xC0:
+            return json.loads(data)
+        header, data = data[0], data[1:]
+        compression = header & 0x03
+        if compression == self.compressions['zlib']:
+            data = zlib.decompress(data)
+        elif compression == self.compressions['lz4']:
+            if lz4 is None:
+                raise ValueError('The lz4 package is not installed')
+            data = lz4.decompress(data)
+        if (header >> 2) & 0x03 == self.serializers['msgpack']:
+            if msgpack is None:
+                raise ValueError('The msgpack package is not installed')
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        return json.loads(data)
+
+
 @implementer(ICacheService)
 class RedisCache(object):
-    def __init__(self, uri, prefix):
-        host, port = uri.replace('redis://', '').split(':')
-        self._client = redis.Redis(host=host, port=port)
+    lock_timeout = 30
+    wait_timeout = 10
+    wait_interval = 0.05
+
+    # the sizes of the largest keys are kept for the stats
+    key_sizes_limit = 100
+    # keys of flushed generations are removed by their expiration
+    default_expire = 7 * 86400
+
+    def __init__(self, uri, prefix, connection_pool=None, codec=None):
+        if connection_pool is None:
+            host, port = uri.replace('redis://', '').split(':')
+            self._client = redis.Redis(host=host, port=port)
+        else:
+            self._client = redis.Redis(connection_pool=connection_pool)
         self._prefix = '%s:mc' % prefix
+        self._sizes_key = '%s:mc-sizes' % prefix
+        self._generation_key = '%s:mc-generation' % prefix
+        self._codec = codec or CacheCodec()
+        self._release_lock = self._client.register_script(RELEASE_LOCK_SCRIPT)
+
+    def generation(self):
+        "returns the generation number that is part of all keys"
+        generation = GENERATIONS.get(self._generation_key)
+        if generation is None:
+            generation = int(self._client.get(self._generation_key) or 0)
+            GENERATIONS.set(self._generation_key, generation)
+        return generation
+
+    def _key(self, key):
+        return '%s:%s:%s' % (self._prefix, self.generation(), key)
 
     def get(self, key):
-        result = self._client.get('%s:%s' % (self._prefix, key))
+        return self._client.get(self._key(key))
+
+    def set(self, key, value, expire=None):
+        return self._client.setex(
+            self._key(key), expire or self.default_expire, value)
+
+    def get_object(self, key):
+        "returns the decoded value of a key"
+        result = self.get(key)
         if result is not None:
-            result = result
+            result = self._codec.decode(result)
         return result
 
+    def set_object(self, key, value, expire=None):
+        "encodes the value and stores it in a key"
+        data = self._codec.encode(value)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.setex(self._key(key), expire or self.default_expire, data)
+        # keep track of the largest keys
+        pipe.zadd(self._sizes_key, {key: len(data)})
+        pipe.zremrangebyrank(self._sizes_key, 0, -self.key_sizes_limit - 1)
+        return pipe.execute()[0]
+
+    def key_sizes(self, limit=20):
+        "returns (key, bytes) tuples of the largest stored objects"
+        return [(key.decode('utf8'), int(size)) for key, size in
+                self._client.zrevrange(
+                    self._sizes_key, 0, limit - 1, withscores=True)]
+
+    def get_or_compute(self, key, compute, expire=None):
+        """Returns the object stored in a key, or stores and returns the
+        result of compute().
+
+        Only one caller in the cluster computes a missing key, other callers
+        wait up to `wait_timeout` seconds for the result, before computing
+        it themselves.
+        """
+        result = self.get_object(key)
+        if result is not None:
+            return result
+        lock_key = self._key('lock:%s' % key)
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.wait_timeout
+        while True:
+            if self._client.set(
+                    lock_key, token, nx=True, ex=self.lock_timeout):
+                try:
+                    result = compute()
+                    self.set_object(key, result, expire)
+                finally:
+                    self._release_lock(keys=[lock_key], args=[token])
+                return result
+            if time.monotonic() > deadline:
+                # the lock holder is too slow, do not wait any longer
+                return compute()
+            time.sleep(self.wait_interval)
+            result = self.get_object(key)
+            if result is not None:
+                return result
+
+    def delete(self, *keys):
+        keys = [self._key(k) for k in keys]
+        return self._client.delete(*keys)
+
+    def flush(self):
+        """Invalidates all keys by starting a new generation, the keys of
+        the old generation expire in time. Other processes see the new
+        generation within a second."""
+        pipe = self._client.pipeline(transaction=False)
+        pipe.incr(self._generation_key)
+        pipe.delete(self._sizes_key)
+        generation = pipe.execute()[0]
+        GENERATIONS.set(self._generation_key, generation)
+        return True
+
+
+# process wide storage of the memory:// cache
+MEMORY_CACHE = LRUCache(max_size=10000)
+MEMORY_GENERATIONS = {}
+MEMORY_KEY_SIZES = {}
+MEMORY_LOCKS = {}
+_memory_lock = threading.Lock()
+
+
+@implementer(ICacheService)
+class MemoryCache(object):
+    """In-process cache service for single node installs and benchmarks.
+    All instances share a bounded LRU, values are stored as bytes, like
+    they are stored in Redis.
+    """
+    key_sizes_limit = 100
+    default_expire = 7 * 86400
+
+    def __init__(self, uri, prefix, connection_pool=None, codec=None):
+        self._prefix = '%s:mc' % prefix
+        self._codec = codec or CacheCodec()
+
+    def generation(self):
+        return MEMORY_GENERATIONS.get(self._prefix, 0)
+
+    def _key(self, key):
+        return (self._prefix, self.generation(), key)
+
+    def get(self, key):
+        return MEMORY_CACHE.get(self._key(key))
+
     def set(self, key, value, expire=None):
-        key = '%s:%s' % (self._prefix, key)
+        if isinstance(value, str):
+            value = value.encode('utf8')
+        elif not isinstance(value, bytes):
+            value = str(value).encode('utf8')
+        MEMORY_CACHE.set(self._key(key), value, expire or self.default_expire)
+        return True
+
+    def get_object(self, key):
+        result = self.get(key)
+        if result is not None:
+            result = self._codec.decode(result)
+        return result
+
+    def set_object(self, key, value, expire=None):
+        data = self._codec.encode(value)
+        with _memory_lock:
+            sizes = MEMORY_KEY_SIZES.setdefault(self._prefix, {})
+            sizes[key] = len(data)
+            if len(sizes) > self.key_sizes_limit:
+                del sizes[min(sizes, key=sizes.get)]
+        return self.set(key, data, expire)
+
+    def key_sizes(self, limit=20):
+        sizes = MEMORY_KEY_SIZES.get(self._prefix, {})
+        return sorted(sizes.items(), key=lambda item: (-item[1], item[0]))[
+            :limit]
+
+    def get_or_compute(self, key, compute, expire=None):
+        result = self.get_object(key)
+        if result is not None:
+            return result
+        lock_key = self._key(key)
+        with _memory_lock:
+            # a [lock, number of callers] list, the last caller removes it
+            entry = MEMORY_LOCKS.setdefault(lock_key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                # only the first caller computes, the others wait for it
+                result = self.get_object(key)
+                if result is None:
+                    result = compute()
+                    self.set_object(key, result, expire)
+        finally:
+            with _memory_lock:
+                entry[1] -= 1
+                if entry[1] == 0 and MEMORY_LOCKS.get(lock_key) is entry:
+                    del MEMORY_LOCKS[lock_key]
+        return result
+
+    def delete(self, *keys):
+        return len([k for k in keys if MEMORY_CACHE.delete(self._key(k))])
+
+    def flush(self):
+        with _memory_lock:
+            MEMORY_GENERATIONS[self._prefix] = self.generation() + 1
+            MEMORY_KEY_SIZES.pop(self._prefix, None)
+        # unlike redis, old generations can be removed right away
+        MEMORY_CACHE.delete_matching(
+            lambda key, value: key[0] == self._prefix)
+        return True
+
+
+@implementer(ICacheService)
+class TwoTierCache(object):
+    """Keeps decoded objects in an in-process LRU cache (L1) in front of
+    another cache service (L2).
+
+    Objects are stored as is, so they should not be modified by the
+    caller. Only use this with keys that change when the value changes,
+    for instance by including a revision number in the key.
+    """
+
+    def __init__(self, cache, l1, prefix):
+        self._cache = cache
+        self._l1 = l1
+        self._prefix = prefix
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, expire=None):
+        return self._cache.set(key, value, expire)
+
+    def generation(self):
+        return self._cache.generation()
+
+    def _l1_key(self, key):
+        return (self._prefix, self._cache.generation(), key)
+
+    def get_object(self, key):
+        l1_key = self._l1_key(key)
+        result = self._l1.get(l1_key)
+        if result is None:
+            result = self._cache.get_object(key)
+            if result is not None:
+                self._l1.set(l1_key, result)
+        return result
+
+    def set_object(self, key, value, expire=None):
+        self._l1.set(self._l1_key(key), value, self._l1_ttl(expire))
+        return self._cache.set_object(key, value, expire)
+
+    def _l1_ttl(self, expire):
         if expire is None:
-            return self._client.set(key, value)
-        else:
-            return self._client.setex(key, expire, value)
+            return self._l1.ttl
+        return min(self._l1.ttl or expire, expire)
+
+    def get_or_compute(self, key, compute, expire=None):
+        l1_key = self._l1_key(key)
+        result = self._l1.get(l1_key)
+        if result is None:
+            result = self._cache.get_or_compute(key, compute, expire)
+            self._l1.set(l1_key, result, self._l1_ttl(expire))
+        return result
 
     def delete(self, *keys):
-        keys = ['%s:%s' % (self._prefix, k) for k in keys]
-        return self._client.delete(*keys)
+        for key in keys:
+            self._l1.delete(self._l1_key(key))
+        return self._cache.delete(*keys)
+
+    def key_sizes(self, limit=20):
+        return self._cache.key_sizes(limit)
 
     def flush(self):
-        key = '%s:*' % self._prefix
-        cursor = '0'
-        count = 0
-        while cursor is not 0:
-            cursor, keys = self._client.scan(
-                cursor=cursor, match=key, count=1000)
-            if keys:
-                count += len(keys)
-                self._client.delete(*keys)
-        return count
+        self._l1.delete_matching(lambda key, value: key[0] == self._prefix)
+        return self._cache.flush()
 
 
 def cache_factory(registry, repository_namespace):
@@ -46,8 +371,32 @@ def cache_factory(registry, repository_namespace):
     CacheImpl = registry.queryUtility(ICacheService, proto)
     prefix = '%s-%s' % (registry.settings['idris.app_prefix'],
                         repository_namespace)
-    return CacheImpl(config_url, prefix)
+    cache = CacheImpl(config_url,
+                      prefix,
+                      connection_pool=redis_pool(registry),
+                      codec=registry.get('cache_codec'))
+    if registry.get('cache_l1') is not None:
+        cache = TwoTierCache(cache, registry['cache_l1'], prefix)
+    return cache
 
 def includeme(config):
     config.registry.registerUtility(
         RedisCache, ICacheService, 'redis')
+    config.registry.registerUtility(
+        MemoryCache, ICacheService, 'memory')
+    settings = config.get_settings()
+    MEMORY_CACHE.max_size = int(settings.get('cache.memory_max_size', 10000))
+    GENERATIONS.ttl = float(settings.get('cache.generation_ttl', 1))
+    try:
+        config.registry['cache_codec'] = CacheCodec(
+            serializer=settings.get('cache.serializer', 'json'),
+            compression=settings.get('cache.compression', 'none'),
+            threshold=int(settings.get('cache.compression_threshold', 1024)))
+    except ValueError as err:
+        raise ConfigurationError(str(err))
+    l1_size = int(settings.get('cache.l1_size', 0))
+    l1 = None
+    if l1_size:
+        l1 = LRUCache(max_size=l1_size,
+                      ttl=int(settings.get('cache.l1_ttl', 300)))
+    config.registry['cache_l1'] = l1
@@ -1,10 +1,85 @@
+import logging
 import datetime
+import threading
 
 from zope.interface import implementer
+from pyramid.settings import asbool
 import redis
 
+from idris.pool import redis_pool
+from idris.utils import (HyperLogLog,
+                         LRUCache,
+                         BackgroundWorker,
+                         register_background_worker,
+                         drain_background_workers)
 from idris.interfaces import IDownloadCounter
 
+# KEYS: expression hash, repo hash, 30 day hll, hll of the day
+# ARGV: expression_id, user identifier, date, date 30 days ago, expire,
+#       number of downloads
+COUNT_SCRIPT = """
+local date, min_date, expire = ARGV[3], ARGV[4], tonumber(ARGV[5])
+local increment = tonumber(ARGV[6])
+local total_hll, hll_key = KEYS[3], KEYS[4]
+
+local function update(key)
+    -- recalculate the 30 day sums and remove the expired dates
+    local history = redis.call('HGETALL', key)
+    local total, u_total, old_keys = 0, 0, {}
+    for i = 1, #history, 2 do
+        local hkey, prefix = history[i], string.sub(history[i], 1, 2)
+        if hkey == 'ts' or hkey == 'us' then
+        elseif prefix == 'ts' or prefix == 'us' then
+            table.insert(old_keys, hkey)
+        elseif string.sub(hkey, 3) <= min_date then
+            table.insert(old_keys, hkey)
+        elseif prefix == 't-' then
+            total = total + tonumber(history[i + 1])
+        elseif prefix == 'u-' then
+            u_total = u_total + tonumber(history[i + 1])
+        end
+    end
+    if #old_keys > 0 then
+        redis.call('HDEL', key, unpack(old_keys))
+    end
+    redis.call('HSET', key, 'ts', total)
+    redis.call('HSET', key, 'us', u_total)
+    redis.call('EXPIRE', key, expire)
+end
+
+local function count(key, hll_value)
+    local t_count = redis.call('HINCRBY', key, 't-' .. date, increment)
+    local u_count = 0
+    if t_count == increment then
+        -- first download today! update history
+        update(key)
+    else
+        redis.call('HINCRBY', key, 'ts', increment)
+    end
+    if redis.call('PFADD', total_hll, hll_value) == 1 then
+        -- this user has not downloaded the file in the last 30 days
+        u_count = redis.call('HINCRBY', key, 'u-' .. date, 1)
+        redis.call('PFADD', hll_key, hll_value)
+        if u_count == 1 then
+            redis.call('EXPIRE', hll_key, expire)
+        end
+        redis.call('HINCRBY', key, 'us', 1)
+    end
+    return {t_count, u_count}
+end
+
+local result = count(KEYS[1], ARGV[1] .. ':' .. ARGV[2])
+if KEYS[1] ~= KEYS[2] then
+    -- increment the global repository count
+    count(KEYS[2], 'repo:' .. ARGV[2])
+end
+return result
+"""
+
+# maps download counter prefixes to the last day the HLL was rotated
+ROTATED = {}
+
+
 @implementer(IDownloadCounter)
 class RedisDownloadCounter(object):
     """
@@ -39,6 +114,12 @@ class RedisDownloadCounter(object):
 
     <prefix>:dc:hll
 
+    This is done by the rotate_hll method, which should be scheduled to run
+    once a day for every repository (see the rotate_downloads script). If
+    it is not scheduled, the first download of a day rotates the HLL, the
+    <prefix>:dc:hll-rotated-<YYYY-MM-DD> key makes sure that only one
+    process does this.
+
     Last all downloads per repository are calculated using the above mechanism, but
     instead of using an integer expression_id, the id 'repo' is used, so:
 
@@ -46,55 +127,22 @@ class RedisDownloadCounter(object):
 
     Will hold the repository historic counts
 
+    A download is counted with a single Lua script (COUNT_SCRIPT), which
+    updates both the expression and the repository counts atomically.
     """
 
-    def __init__(self, uri, prefix, timezone='utc'):
-        host, port = uri.replace('redis://', '').split(':')
-        self._client = redis.Redis(host=host, port=port)
+    def __init__(self, uri, prefix, timezone='utc', connection_pool=None,
+                 buffer=None):
+        if connection_pool is None:
+            host, port = uri.replace('redis://', '').split(':')
+            self._client = redis.Redis(host=host, port=port)
+        else:
+            self._client = redis.Redis(connection_pool=connection_pool)
         self._prefix = '%s:dc' % prefix
+        self._count_script = self._client.register_script(COUNT_SCRIPT)
+        self._buffer = buffer
         self.today = datetime.datetime.utcnow()
 
-    def _update(self, key, when):
-        history = self._client.hgetall(key)
-        min_date = (when - datetime.timedelta(days=30)).strftime('%Y-%m-%d')
-        keys_to_delete = []
-        total = 0
-        u_total = 0
-        for raw_hkey in list(history.keys()):
-            hkey = raw_hkey.decode('utf8')
-            if hkey == 'ts' or hkey == 'us':
-                continue
-            if hkey.startswith('ts-') or hkey.startswith('us-'):
-                keys_to_delete.append(raw_hkey)
-                continue
-            key_date = hkey.split('-', 1)[1]
-            if key_date <= min_date:
-                keys_to_delete.append(raw_hkey)
-                continue
-            if hkey.startswith('t-'):
-                total += int(history[raw_hkey])
-            elif hkey.startswith('u-'):
-                u_total += int(history[raw_hkey])
-        pipe = self._client.pipeline()
-        if keys_to_delete:
-            pipe.hdel(key, *keys_to_delete)
-        pipe.hset(key, 'ts', total)
-        pipe.hset(key, 'us', u_total)
-        pipe.expire(key, 86400 * 31)
-        pipe.execute()
-        return total, u_total
-
-    def _update_hll(self, key, when):
-        hll_keys = []
-        for day in range(30):
-            key_date = (when - datetime.timedelta(days=day)).strftime('%Y-%m-%d')
-            hll_keys.append('%s:hll-%s' % (self._prefix, key_date))
-        total_key = '%s:hll' % self._prefix
-        pipe = self._client.pipeline()
-        pipe.delete(total_key)
-        pipe.pfmerge(total_key, *hll_keys)
-        pipe.execute()
-
     def history(self, expression_id):
         base_key = '%s:%s' % (self._prefix, expression_id)
         history = {}
@@ -118,40 +166,104 @@ class RedisDownloadCounter(object):
             pipe.hget(key, 'us')
         return [int(count or 0) for count in  pipe.execute()]
 
+    def _count_args(self, expression_id, user_identifier, when, increment):
+        download_time = when.strftime('%Y-%m-%d')
+        min_date = (when - datetime.timedelta(days=30)).strftime('%Y-%m-%d')
+        keys = ['%s:%s' % (self._prefix, expression_id),
+                '%s:repo' % self._prefix,
+                '%s:hll' % self._prefix,
+                '%s:hll-%s' % (self._prefix, download_time)]
+        args = [expression_id, user_identifier,
+                download_time, min_date, 86400 * 31, increment]
+        return keys, args
+
     def count(self, expression_id, user_identifier, when=None):
         when = when or self.today
-        download_time = when.strftime('%Y-%m-%d')
-        key = '%s:%s' % (self._prefix, expression_id)
-        hll_key = '%s:hll-%s' % (self._prefix, download_time)
-        hll_value = '%s:%s' % (expression_id, user_identifier)
-        t_count = self._client.hincrby(key, 't-%s' % download_time, 1)
-        u_count = 0
+        if self._buffer is not None:
+            # the download is written to redis by the buffer flusher
+            self._buffer.add(self, expression_id, user_identifier, when)
+            return None, None
+        self._rotate_daily()
+        keys, args = self._count_args(expression_id, user_identifier, when, 1)
+        t_count, u_count = self._count_script(keys=keys, args=args)
+        return t_count, u_count
 
-        if t_count == 1:
-            # first download today! update history
-            self._client.expire(key, 86400 * 31) # 31 days
-            self._update(key, when)
-            self._update_hll(key, when)
-        else:
-            self._client.hincrby(key, 'ts', 1)
+    def count_many(self, downloads):
+        """Count a batch of (expression_id, user_identifier, when, number)
+        downloads in a single MULTI/EXEC transaction.
 
-        if self._client.pfadd(
-                '%s:hll' % self._prefix, hll_value) == 1:
-            # this user has not downloaded the file in the last 30 days
-            u_count = self._client.hincrby(key, 'u-%s' % download_time, 1)
-            pipe = self._client.pipeline()
-            pipe.pfadd(hll_key, hll_value)
-            if u_count == 1:
-                # first unique download of today!
-                pipe.expire(hll_key, 86400 * 31) # 31 days
-
-            pipe.hincrby(key, 'us', 1)
-            pipe.execute()
-        if expression_id != 'repo':
-            # increment the global repository count
-            # by calling ourself with 'repo' as expression_id
-            self.count('repo', user_identifier, when=when)
-        return t_count, u_count
+        Returns the (total, unique) counts of every download, or the error
+        of a download that could not be counted. If the transaction itself
+        fails a RedisError is raised, and none of the downloads are counted.
+        """
+        self._rotate_daily()
+        pipe = self._client.pipeline(transaction=True)
+        for expression_id, user_identifier, when, number in downloads:
+            keys, args = self._count_args(
+                expression_id, user_identifier, when, number)
+            self._count_script(keys=keys, args=args, client=pipe)
+        return pipe.execute(raise_on_error=False)
+
+    def _rotate_daily(self):
+        "Rotate the HLL on the first download of the day"
+        today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+        if ROTATED.get(self._prefix) == today:
+            return
+        marker = '%s:hll-rotated-%s' % (self._prefix, today)
+        if self._client.set(marker, 1, nx=True, ex=86400):
+            self.rotate_hll()
+        ROTATED[self._prefix] = today
+
+    def rotate_hll(self, when=None):
+        """Merge the HLLs of the last 30 days into the repository wide HLL.
+
+        The merge is built in a temporary key that replaces the current HLL
+        in a single transaction, so the HLL is never empty.
+        """
+        when = when or datetime.datetime.utcnow()
+        hll_keys = []
+        for day in range(30):
+            key_date = (when - datetime.timedelta(days=day)).strftime(
+                '%Y-%m-%d')
+            hll_keys.append('%s:hll-%s' % (self._prefix, key_date))
+        total_key = '%s:hll' % self._prefix
+        tmp_key = '%s:hll-merge' % self._prefix
+        pipe = self._client.pipeline(transaction=True)
+        pipe.delete(tmp_key)
+        pipe.pfmerge(tmp_key, *hll_keys)
+        pipe.rename(tmp_key, total_key)
+        pipe.execute()
+
+    def daily_counts(self):
+        """Yields (expression_id, date, total, unique) for every day
+        in the history of every expression, including 'repo'"""
+        cursor = '0'
+        while cursor != 0:
+            cursor, keys = self._client.scan(
+                cursor=cursor, match='%s:*' % self._prefix, count=1000)
+            keys = [k for k in keys
+                    if not k.decode('utf8').startswith(
+                        '%s:hll' % self._prefix)]
+            pipe = self._client.pipeline(transaction=False)
+            for key in keys:
+                pipe.hgetall(key)
+            for key, history in zip(keys, pipe.execute()):
+                expression_id = key.decode('utf8')[len(self._prefix) + 1:]
+                days = {}
+                for hkey, value in history.items():
+                    hkey = hkey.decode('utf8')
+                    if hkey[:2] not in ('t-', 'u-'):
+                        continue
+                    counts = days.setdefault(hkey[2:], [0, 0])
+                    if hkey.startswith('t-'):
+                        counts[0] = int(value)
+                    else:
+                        counts[1] = int(value)
+                for date, (total, unique) in sorted(days.items()):
+                    yield (expression_id,
+                           datetime.datetime.strptime(date, '%Y-%m-%d').date(),
+                           total,
+                           unique)
 
     def flush(self):
         key = '%s:*' % self._prefix
@@ -165,14 +277,341 @@ class RedisDownloadCounter(object):
                 self._client.delete(*keys)
         return count
 
+# process wide storage of the memory:// download counters, keyed by
+# (prefix, key). The least recently used keys are evicted when more then
+# `download_counter.memory_max_size` keys are stored.
+MEMORY_COUNTERS = LRUCache(max_size=100000)
+MEMORY_LOCKS = {}
+_memory_lock = threading.Lock()
+
+
+@implementer(IDownloadCounter)
+class MemoryDownloadCounter(object):
+    """In-process download counter for single node installs and benchmarks.
+
+    It stores the same hashes and HyperLogLogs as the RedisDownloadCounter,
+    and counts with the same algorithm as the COUNT_SCRIPT. Expired keys
+    are purged on the first write of the day and on rotation, the number
+    of keys is bounded by the MEMORY_COUNTERS LRU cache.
+    """
+
+    expire = 86400 * 31
+
+    def __init__(self, uri, prefix, timezone='utc', connection_pool=None,
+                 buffer=None):
+        self._prefix = '%s:dc' % prefix
+        with _memory_lock:
+            self._lock = MEMORY_LOCKS.setdefault(self._prefix,
+                                                 threading.RLock())
+        self._buffer = buffer
+        self._purged = None
+        self.today = datetime.datetime.utcnow()
+
+    def _get(self, key, factory=None):
+        value = MEMORY_COUNTERS.get((self._prefix, key))
+        if value is None and factory is not None:
+            value = factory()
+            MEMORY_COUNTERS.set((self._prefix, key), value)
+        return value
+
+    def _set(self, key, value, ttl=None):
+        MEMORY_COUNTERS.set((self._prefix, key), value, ttl=ttl)
+
+    def _expire(self, key):
+        value = self._get(key)
+        if value is not None:
+            self._set(key, value, ttl=self.expire)
+
+    def _keys(self):
+        return [key for prefix, key in MEMORY_COUNTERS.keys()
+                if prefix == self._prefix]
+
+    def history(self, expression_id):
+        with self._lock:
+            return dict(self._get(str(expression_id)) or {})
+
+    def get_total_counts(self, expression_ids, when=None):
+        with self._lock:
+            return [(self._get(str(i)) or {}).get('ts', 0)
+                    for i in expression_ids]
+
+    def get_unique_counts(self, expression_ids, when=None):
+        with self._lock:
+            return [(self._get(str(i)) or {}).get('us', 0)
+                    for i in expression_ids]
+
+    def _update(self, key, history, min_date):
+        # recalculate the 30 day sums and remove the expired dates
+        total = u_total = 0
+        for hkey in list(history.keys()):
+            if hkey in ('ts', 'us'):
+                continue
+            if hkey[:2] in ('ts', 'us') or hkey[2:] <= min_date:
+                del history[hkey]
+            elif hkey.startswith('t-'):
+                total += history[hkey]
+            elif hkey.startswith('u-'):
+                u_total += history[hkey]
+        history['ts'] = total
+        history['us'] = u_total
+        self._expire(key)
+
+    def _count(self, key, hll_value, date, min_date, increment):
+        history = self._get(key, dict)
+        t_key = 't-%s' % date
+        t_count = history[t_key] = history.get(t_key, 0) + increment
+        u_count = 0
+        if t_count == increment:
+            # first download today! update history
+            self._update(key, history, min_date)
+        else:
+            history['ts'] = history.get('ts', 0) + increment
+        if self._get('hll', HyperLogLog).add(hll_value):
+            # this user has not downloaded the file in the last 30 days
+            u_key = 'u-%s' % date
+            u_count = history[u_key] = history.get(u_key, 0) + 1
+            hll_key = 'hll-%s' % date
+            self._get(hll_key, HyperLogLog).add(hll_value)
+            if u_count == 1:
+                self._expire(hll_key)
+            history['us'] = history.get('us', 0) + 1
+        return t_count, u_count
+
+    def _count_increment(self, expression_id, user_identifier, when,
+                         increment):
+        date = when.strftime('%Y-%m-%d')
+        min_date = (when - datetime.timedelta(days=30)).strftime('%Y-%m-%d')
+        with self._lock:
+            if self._purged != date:
+                # first write of the day, drop the expired keys
+                MEMORY_COUNTERS.purge_expired()
+                self._purged = date
+            marker = 'hll-rotated-%s' % (
+                datetime.datetime.utcnow().strftime('%Y-%m-%d'))
+            if self._get(marker) is None:
+                # rotate the HLL on the first download of the day
+                self._set(marker, True, ttl=86400)
+                self.rotate_hll()
+            result = self._count(str(expression_id),
+                                 '%s:%s' % (expression_id, user_identifier),
+                                 date,
+                                 min_date,
+                                 increment)
+            if str(expression_id) != 'repo':
+                # increment the global repository count
+                self._count('repo',
+                            'repo:%s' % user_identifier,
+                            date,
+                            min_date,
+                            increment)
+        return result
+
+    def count(self, expression_id, user_identifier, when=None):
+        when = when or self.today
+        if self._buffer is not None:
+            self._buffer.add(self, expression_id, user_identifier, when)
+            return None, None
+        return self._count_increment(expression_id, user_identifier, when, 1)
+
+    def count_many(self, downloads):
+        return [self._count_increment(*download) for download in downloads]
+
+    def rotate_hll(self, when=None):
+        when = when or datetime.datetime.utcnow()
+        merged = HyperLogLog()
+        with self._lock:
+            for day in range(30):
+                key_date = (when - datetime.timedelta(days=day)).strftime(
+                    '%Y-%m-%d')
+                hll = self._get('hll-%s' % key_date)
+                if hll is not None:
+                    merged.merge(hll)
+            self._set('hll', merged)
+            # the daily hlls outside of the 30 day window are not needed
+            min_key = 'hll-%s' % (
+                when - datetime.timedelta(days=30)).strftime('%Y-%m-%d')
+            MEMORY_COUNTERS.delete_matching(
+                lambda k, v: (k[0] == self._prefix and
+                              k[1].startswith('hll-') and k[1] <= min_key))
+            MEMORY_COUNTERS.purge_expired()
+
+    def daily_counts(self):
+        with self._lock:
+            histories = [(key, dict(self._get(key)))
+                         for key in self._keys()
+                         if not key.startswith('hll') and self._get(key)]
+        for expression_id, history in histories:
+            days = {}
+            for hkey, value in history.items():
+                if hkey[:2] not in ('t-', 'u-'):
+                    continue
+                counts = days.setdefault(hkey[2:], [0, 0])
+                if hkey.startswith('t-'):
+                    counts[0] = value
+                else:
+                    counts[1] = value
+            for date, (total, unique) in sorted(days.items()):
+                yield (expression_id,
+                       datetime.datetime.strptime(date, '%Y-%m-%d').date(),
+                       total,
+                       unique)
+
+    def flush(self):
+        with self._lock:
+            return MEMORY_COUNTERS.delete_matching(
+                lambda k, v: k[0] == self._prefix)
+
+
+class DownloadBuffer(BackgroundWorker):
+    """Collects downloads in process and writes them to Redis in batches,
+    every `interval` seconds or as soon as `max_size` downloads are
+    buffered. Repeated downloads of a file by the same user on the same day
+    are coalesced into a single increment.
+
+    Downloads that could not be written are kept for the next flush, up to
+    `max_pending` downloads (100 times `max_size` by default), above that
+    the oldest downloads are dropped.
+    """
+
+    thread_name = 'download-counter-flusher'
+
+    def __init__(self, interval=1.0, max_size=100, max_pending=None):
+        super(DownloadBuffer, self).__init__()
+        self.interval = interval
+        self.max_size = max_size
+        self.max_pending = max_pending or max_size * 100
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._counters = {}
+        self._downloads = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, counter, expression_id, user_identifier, when):
+        key = (counter._prefix,
+               expression_id,
+               user_identifier,
+               when.strftime('%Y-%m-%d'))
+        with self._lock:
+            self._counters[counter._prefix] = counter
+            self._downloads[key] = self._downloads.get(key, 0) + 1
+            self._size += 1
+            full = self._size >= self.max_size
+        self.start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        "Write all buffered downloads to Redis, returns the number written"
+        with self._flush_lock:
+            with self._lock:
+                downloads, self._downloads = self._downloads, {}
+                counters = dict(self._counters)
+                self._size = 0
+            batches = {}
+            for (prefix, expression_id, user_identifier, date), number in (
+                    downloads.items()):
+                batches.setdefault(prefix, []).append(
+                    (expression_id,
+                     user_identifier,
+                     datetime.datetime.strptime(date, '%Y-%m-%d'),
+                     number))
+            written = 0
+            for prefix, batch in batches.items():
+                try:
+                    results = counters[prefix].count_many(batch)
+                except redis.RedisError as err:
+                    logging.warning(
+                        'Writing %s buffered downloads failed: %s' % (
+                            len(batch), err))
+                    self._restore(prefix, batch)
+                    continue
+                # only restore the downloads that were not counted, the
+                # others are written and must not be counted twice
+                failed = [download for download, result in zip(batch, results)
+                          if isinstance(result, Exception)]
+                if failed:
+                    logging.warning(
+                        'Writing %s of %s buffered downloads failed: %s' % (
+                            len(failed), len(batch),
+                            next(result for result in results
+                                 if isinstance(result, Exception))))
+                    self._restore(prefix, failed)
+                written += sum(number for *_, number in batch)
+                written -= sum(number for *_, number in failed)
+            return written
+
+    def _restore(self, prefix, batch):
+        with self._lock:
+            for expression_id, user_identifier, when, number in batch:
+                key = (prefix,
+                       expression_id,
+                       user_identifier,
+                       when.strftime('%Y-%m-%d'))
+                self._downloads[key] = self._downloads.get(key, 0) + number
+                self._size += number
+            overflow = self._size - self.max_pending
+            if overflow > 0:
+                # redis is unavailable for a while, drop the oldest
+                # downloads instead of buffering without limit
+                dropped = 0
+                for key in sorted(self._downloads, key=lambda key: key[3]):
+                    if dropped >= overflow:
+                        break
+                    dropped += self._downloads.pop(key)
+                self._size -= dropped
+                logging.error(
+                    'Download buffer is full, dropped %s downloads' % dropped)
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception('Flushing buffered downloads failed')
+
+    def drain(self):
+        "Write all buffered downloads, called on shutdown"
+        return self.flush()
+
+
+def flush_download_buffers():
+    "Write the buffered downloads of all applications in this process"
+    return drain_background_workers(DownloadBuffer)
+
+
 def download_counter_factory(registry, repository_namespace):
     config_url = registry.settings['cache.url']
     proto = config_url.split('://')[0]
     CounterImpl = registry.queryUtility(IDownloadCounter, proto)
     prefix = '%s-%s' % (registry.settings['idris.app_prefix'],
                         repository_namespace)
-    return CounterImpl(config_url, prefix)
+    return CounterImpl(config_url,
+                       prefix,
+                       connection_pool=redis_pool(registry),
+                       buffer=registry.get('download_buffer'))
 
 def includeme(config):
     config.registry.registerUtility(
         RedisDownloadCounter, IDownloadCounter, 'redis')
+    config.registry.registerUtility(
+        MemoryDownloadCounter, IDownloadCounter, 'memory')
+    settings = config.get_settings()
+    MEMORY_COUNTERS.max_size = int(
+        settings.get('download_counter.memory_max_size', 100000))
+    buffer = None
+    if asbool(settings.get('download_counter.buffered', False)):
+        # write downloads to redis in batches, outside of the request
+        buffer = DownloadBuffer(
+            interval=int(
+                settings.get('download_counter.buffer_interval', 1000)) / 1000,
+            max_size=int(settings.get('download_counter.buffer_size', 100)),
+            max_pending=int(
+                settings.get('download_counter.buffer_max_pending', 0)))
+        register_background_worker(buffer)
+    config.registry['download_buffer'] = buffer
@@ -0,0 +1,122 @@
+import sqlalchemy as sql
+from sqlalchemy.dialects.postgresql import insert
+from zope.sqlalchemy import mark_changed
+
+from idris.models import DownloadStats
+
+# the download counter counts downloads of course materials, so
+# downloads of an expression are counted on the work of the expression
+GROUP_BY_QUERIES = {
+    'repository': """
+        SELECT NULL AS id, {period} AS period,
+               SUM(ds.total) AS total, SUM(ds.unique) AS unique
+        FROM download_stats ds
+        WHERE ds.work_id IS NULL AND ds.date >= :start_date
+          AND ds.date <= :end_date
+        GROUP BY period ORDER BY period""",
+    'work': """
+        SELECT ds.work_id AS id, {period} AS period,
+               SUM(ds.total) AS total, SUM(ds.unique) AS unique
+        FROM download_stats ds
+        WHERE ds.work_id IS NOT NULL AND ds.date >= :start_date
+          AND ds.date <= :end_date {filter}
+        GROUP BY ds.work_id, period ORDER BY ds.work_id, period""",
+    'course': """
+        SELECT toc.work_id AS id, {period} AS period,
+               SUM(ds.total) AS total, SUM(ds.unique) AS unique
+        FROM download_stats ds
+        JOIN relations toc ON toc.target_id = ds.work_id AND toc.type = 'toc'
+        WHERE ds.date >= :start_date AND ds.date <= :end_date {filter}
+        GROUP BY toc.work_id, period ORDER BY toc.work_id, period""",
+    'group': """
+        SELECT wg.group_id AS id, {period} AS period,
+               SUM(ds.total) AS total, SUM(ds.unique) AS unique
+        FROM download_stats ds
+        JOIN (SELECT c.work_id, c.group_id
+              FROM contributors c WHERE c.group_id IS NOT NULL
+              UNION
+              SELECT toc.target_id AS work_id, c.group_id
+              FROM contributors c
+              JOIN relations toc ON toc.work_id = c.work_id
+              WHERE toc.type = 'toc' AND c.group_id IS NOT NULL
+             ) wg ON wg.work_id = ds.work_id
+        WHERE ds.date >= :start_date AND ds.date <= :end_date {filter}
+        GROUP BY wg.group_id, period ORDER BY wg.group_id, period"""}
+
+GROUP_BY_FILTERS = {'work': 'AND ds.work_id IN :ids',
+                    'course': 'AND toc.work_id IN :ids',
+                    'group': 'AND wg.group_id IN :ids'}
+
+PERIODS = {None: 'NULL',
+           'day': "to_char(ds.date, 'YYYY-MM-DD')",
+           'month': "to_char(ds.date, 'YYYY-MM')",
+           'year': "to_char(ds.date, 'YYYY')"}
+
+
+def rollup_downloads(session, downloads):
+    """Copy the daily counts of the download counter into the download_stats
+    table of the repository. Days that were already rolled up are
+    overwritten with an upsert, so this can be run as often as needed, even
+    concurrently, as long as it runs at least once every 30 days.
+
+    Returns the number of rolled up days.
+    """
+    counts = {}
+    for expression_id, date, total, unique in downloads.daily_counts():
+        if expression_id == 'repo':
+            work_id = None
+        elif expression_id.isdigit():
+            work_id = int(expression_id)
+        else:
+            continue
+        counts[(work_id, date)] = (total, unique)
+    if not counts:
+        return 0
+    table = DownloadStats.__table__
+    statement = insert(table).values(
+        [{'work_id': work_id, 'date': date, 'total': total, 'unique': unique}
+         for (work_id, date), (total, unique) in counts.items()])
+    statement = statement.on_conflict_do_update(
+        index_elements=[sql.func.coalesce(table.c.work_id, 0), table.c.date],
+        set_={'total': statement.excluded.total,
+              'unique': statement.excluded.unique})
+    session.execute(statement)
+    mark_changed(session)
+    return len(set(date for work_id, date in counts))
+
+
+def download_statistics(session,
+                        start_date,
+                        end_date,
+                        group_by='work',
+                        ids=None,
+                        period=None):
+    """Returns the downloads between start_date and end_date (inclusive) as
+    a list of dicts with id, period, total and unique keys.
+
+    Downloads can be grouped by 'repository', 'work' (or 'expression'),
+    'course' or 'group', optionally limited to the given ids. The period can
+    be None for the whole date range, or 'day', 'month' or 'year'.
+    Note that unique downloads are summed per day, so a user downloading
+    on multiple days is counted multiple times.
+    """
+    if group_by == 'expression':
+        group_by = 'work'
+    if group_by not in GROUP_BY_QUERIES:
+        raise ValueError('Unknown group_by: %s' % group_by)
+    if period not in PERIODS:
+        raise ValueError('Unknown period: %s' % period)
+    params = dict(start_date=start_date, end_date=end_date)
+    filter = ''
+    if ids is not None and group_by in GROUP_BY_FILTERS:
+        filter = GROUP_BY_FILTERS[group_by]
+        params['ids'] = tuple(ids) or (None,)
+    query = sql.text(GROUP_BY_QUERIES[group_by].format(
+        period=PERIODS[period], filter=filter))
+    result = []
+    for row in session.execute(query, params):
+        result.append({'id': row.id,
+                       'period': row.period,
+                       'total': int(row.total),
+                       'unique': int(row.unique)})
+    return result
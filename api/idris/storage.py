@@ -1,9 +1,14 @@
 import os
 import uuid
 import logging
+import time
+import threading
 
+import redis
 from pyramid.decorator import reify
-from sqlalchemy import engine_from_config
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.settings import asbool
+from sqlalchemy import engine_from_config, event, exc
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.schema import CreateSchema, DropSchema
 from sqlalchemy.engine import reflection
@@ -11,11 +16,18 @@ import zope.sqlalchemy
 import transaction
 
 from idris.services.cache import cache_factory
-from idris.services.auditlog import auditlog_factory
+from idris.services.auditlog import auditlog_factory, create_audit_logs
 from idris.services.download_counter import download_counter_factory
 
 from idris.interfaces import IBlobStoreBackend
 from idris.blob import BlobStore
+from idris.pool import (MeteredQueuePool,
+                        TenantBudget,
+                        tenant_pool_limits,
+                        tenant_pool_options,
+                        tenant_pool_total,
+                        redis_pool)
+from idris.utils import LRUCache, BackgroundWorker
 from idris.models import (Base,
                           Repository,
                           User, UserGroup,
@@ -116,6 +128,7 @@ class Storage(object):
         return revisions
 
     def create_repository(self, session, namespace, vhost_name, app_name, settings=None):
+        REPOSITORY_CACHE.delete(vhost_name)
         self.registry['engine'].execute(CreateSchema(namespace))
         repository_secret = uuid.uuid4().hex
         session.add(
@@ -135,6 +148,9 @@ class Storage(object):
         session.flush()
 
     def drop_repository(self, session, namespace):
+        invalidate_repository_cache(namespace)
+        if self.registry.get('tenant_engines') is not None:
+            self.registry['tenant_engines'].dispose(namespace)
         self.registry['engine'].execute(DropSchema(namespace, cascade=True))
         repo = session.query(Repository).filter(
             Repository.namespace == namespace).first()
@@ -153,6 +169,12 @@ class Storage(object):
         Repository.__table__.drop(bind=session.connection())
 
     def make_session(self, namespace=None, transaction_manager=None):
+        tenant_engines = self.registry.get('tenant_engines')
+        if namespace and tenant_engines is not None:
+            return get_tm_session(
+                self.registry['dbsession_factory'],
+                transaction_manager or transaction.manager,
+                bind=tenant_engines.get(namespace))
         session = get_tm_session(
             self.registry['dbsession_factory'],
             transaction_manager or transaction.manager)
@@ -230,9 +252,86 @@ class Storage(object):
         session.flush()
         session.execute('SET search_path TO public')
         session.flush()
+        # the audit logs are created outside of the transaction,
+        # once the repository schema is committed
+        def create_logs(session):
+            try:
+                create_audit_logs(self.registry, namespace)
+            except Exception:
+                # missing logs are created when they are appended to
+                logging.exception(
+                    'Creating the audit logs of %s failed' % namespace)
+
+        event.listen(session, 'after_commit', create_logs, once=True)
+
+
+class TenantEngines(object):
+    """Keeps a separate engine (and connection pool) per repository
+    namespace.
+
+    Connections are opened with the search_path of the namespace,
+    so no `SET search_path` statement is needed when a connection is
+    checked out, and pooled connections are never shared between tenants.
+
+    The size of each tenant pool is configured with the
+    idris.tenant_pool.* settings, see `idris.pool.tenant_pool_limits`.
+    All pools share the `budget` of connections of the process.
+    """
 
-
-def get_tm_session(session_factory, transaction_manager):
+    def __init__(self, settings, prefix='sqlalchemy.', budget=None):
+        self.settings = settings
+        self.prefix = prefix
+        self.budget = budget
+        self._engines = {}
+        self._lock = threading.Lock()
+
+    def create_engine(self, namespace):
+        engine = engine_from_config(
+            self.settings,
+            prefix=self.prefix,
+            connect_args={
+                'options': '-c search_path=%s,public' % namespace},
+            **tenant_pool_options(self.settings, namespace))
+        engine.pool.budget = self.budget
+        engine.pool.namespace = namespace
+        return engine
+
+    def get(self, namespace):
+        engine = self._engines.get(namespace)
+        if engine is None:
+            with self._lock:
+                engine = self._engines.get(namespace)
+                if engine is None:
+                    engine = self.create_engine(namespace)
+                    self._engines[namespace] = engine
+        return engine
+
+    def dispose(self, namespace):
+        with self._lock:
+            engine = self._engines.pop(namespace, None)
+        if engine is not None:
+            engine.dispose()
+
+    def items(self):
+        return sorted(self._engines.items())
+
+    def __contains__(self, namespace):
+        return namespace in self._engines
+
+
+REPLICA_STICKY_COOKIE = 'idris_primary'
+
+
+def set_search_path_on_begin(session, namespace):
+    """Set the search_path to the repository namespace whenever the
+    session begins a new transaction on a connection. This way no connection
+    is checked out before the session actually executes a query."""
+    def set_search_path(session, transaction, connection):
+        connection.execute('SET search_path TO %s, public' % namespace)
+    event.listen(session, 'after_begin', set_search_path)
+
+
+def get_tm_session(session_factory, transaction_manager, bind=None):
     """
     Get a ``sqlalchemy.orm.Session`` instance backed by a transaction.
 
@@ -252,15 +351,132 @@ def get_tm_session(session_factory, transaction_manager):
           with transaction.manager:
               dbsession = get_tm_session(session_factory, transaction.manager)
 
+    Pass an engine as `bind` to override the engine of the session_factory.
     """
-    dbsession = session_factory()
+    if bind is None:
+        dbsession = session_factory()
+    else:
+        dbsession = session_factory(bind=bind)
 
     zope.sqlalchemy.register(
         dbsession, transaction_manager=transaction_manager)
     return dbsession
 
 
-REPOSITORY_CONFIG = {}
+# maps vhost names to repository info, so that a request does not have
+# to query the repositories table before doing any real work.
+# Entries are invalidated when a repository row is changed in this process,
+# other processes will pick up changes when the entry expires.
+REPOSITORY_CACHE = LRUCache(max_size=128, ttl=60)
+
+
+def invalidate_repository_cache(namespace):
+    "Remove all vhost entries pointing to a repository namespace"
+    return REPOSITORY_CACHE.delete_matching(
+        lambda host, info: info['namespace'] == namespace)
+
+
+@event.listens_for(Repository, 'after_insert')
+@event.listens_for(Repository, 'after_update')
+@event.listens_for(Repository, 'after_delete')
+def repository_changed(mapper, connection, target):
+    # the config_revision (version_id_col) is incremented on every update
+    REPOSITORY_CACHE.delete(target.vhost_name)
+    invalidate_repository_cache(target.namespace)
+
+
+def lookup_repository(session, host):
+    """Returns a dict with namespace, app, settings and config_revision
+    for the repository hosted on vhost `host`, or None.
+
+    Results are served from the REPOSITORY_CACHE when possible.
+    """
+    info = REPOSITORY_CACHE.get(host)
+    if info is None:
+        # the repositories table lives in the public schema, regardless of
+        # the search_path that might be set on the connection
+        repository = session.query(Repository).filter(
+            Repository.vhost_name == host).execution_options(
+                schema_translate_map={None: 'public'}).first()
+        if repository is None:
+            return
+        info = {'namespace': repository.namespace,
+                'app': repository.app,
+                'settings': repository.settings,
+                'config_revision': repository.config_revision}
+        REPOSITORY_CACHE.set(host, info)
+    return info
+
+
+# maps namespaces to a (config_revision, type config) tuple. Only the
+# latest revision of a repository is kept.
+TYPE_CONFIG_CACHE = LRUCache(max_size=128)
+
+
+class RepositoryChangeListener(BackgroundWorker):
+    """Broadcasts repository changes to all processes using Redis pub/sub.
+
+    When a repository changes (for instance when the type config is
+    updated), the namespace is published on the channel. Every process
+    runs a listener thread that removes the namespace from the
+    REPOSITORY_CACHE and the TYPE_CONFIG_CACHE when a message arrives.
+    """
+
+    thread_name = 'repository-change-listener'
+
+    def __init__(self, redis_url, channel, connection_pool=None):
+        super(RepositoryChangeListener, self).__init__()
+        self.channel = channel
+        if connection_pool is None:
+            self._client = redis.Redis.from_url(redis_url)
+        else:
+            self._client = redis.Redis(connection_pool=connection_pool)
+
+    def publish(self, namespace):
+        try:
+            return self._client.publish(self.channel, namespace)
+        except redis.RedisError as err:
+            logging.warning(
+                'Publishing change of repository %s failed: %s' % (
+                    namespace, err))
+
+    def run(self):
+        while True:
+            try:
+                pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    invalidate_repository(message['data'].decode('utf8'))
+            except redis.RedisError as err:
+                logging.warning(
+                    'Listening for repository changes failed: %s' % err)
+                time.sleep(1)
+
+
+def invalidate_repository(namespace):
+    "Remove all cached information of a repository in this process"
+    invalidate_repository_cache(namespace)
+    TYPE_CONFIG_CACHE.delete(namespace)
+
+
+REPOSITORY_CHANGE_LISTENERS = {}
+
+
+def repository_change_listener(registry):
+    """Returns the process wide RepositoryChangeListener for the redis
+    server configured in cache.url, or None if no redis server is used.
+    """
+    redis_url = registry.settings.get('cache.url', '')
+    if not redis_url.startswith('redis://'):
+        return
+    channel = '%s:repository-changes' % registry.settings['idris.app_prefix']
+    key = (redis_url, channel)
+    if key not in REPOSITORY_CHANGE_LISTENERS:
+        REPOSITORY_CHANGE_LISTENERS[key] = RepositoryChangeListener(
+            redis_url, channel, connection_pool=redis_pool(registry))
+    return REPOSITORY_CHANGE_LISTENERS[key]
 
 
 class RepositoryConfig(object):
@@ -289,13 +505,11 @@ class RepositoryConfig(object):
         self._blob_store = None
         self.config_revision = config_revision
         self.settings = settings or {}
-        if self.config_revision in REPOSITORY_CONFIG.get(self.namespace, {}):
-            self.cached_config = REPOSITORY_CONFIG[
-                self.namespace][self.config_revision]
+        cached = TYPE_CONFIG_CACHE.get(self.namespace)
+        if cached is not None and cached[0] == self.config_revision:
+            self.cached_config = cached[1]
         else:
             self.cached_config = {}
-            REPOSITORY_CONFIG[self.namespace] = {
-                self.config_revision: {}}
 
     @reify
     def blob(self):
@@ -323,6 +537,7 @@ class RepositoryConfig(object):
         repo.settings = self.settings
         self.session.add(repo)
         self.session.flush()
+        self._notify_change()
 
     def type_config(self, type):
         if type in self.cached_config:
@@ -333,10 +548,25 @@ class RepositoryConfig(object):
             for setting in self.session.query(orm_table).all():
                 values.append({'key': setting.key, 'label': setting.label})
             self.cached_config[type] = values
-            REPOSITORY_CONFIG[self.namespace][
-                self.config_revision] = self.cached_config
+            cached = TYPE_CONFIG_CACHE.get(self.namespace)
+            if cached is None or cached[0] <= self.config_revision:
+                # replaces (and evicts) the config of older revisions
+                TYPE_CONFIG_CACHE.set(
+                    self.namespace,
+                    (self.config_revision, self.cached_config))
         return values
 
+    def _notify_change(self):
+        """Tell all processes that the repository changed, once
+        the current transaction is committed"""
+        listener = repository_change_listener(self.registry)
+        if listener is None:
+            return
+        event.listen(self.session,
+                     'after_commit',
+                     lambda session: listener.publish(self.namespace),
+                     once=True)
+
     def put_type_config(self, orm_table, values):
         values = dict((v['key'], v['label']) for v in values)
         for item in self.session.query(orm_table).all():
@@ -356,6 +586,7 @@ class RepositoryConfig(object):
         self.cached_config = {}
         self.session.add(repo)
         self.session.flush()
+        self._notify_change()
 
 
 def includeme(config):
@@ -367,6 +598,13 @@ def includeme(config):
     """
     settings = config.get_settings()
 
+    REPOSITORY_CACHE.max_size = int(
+        settings.get('idris.repository_cache_size', 128))
+    REPOSITORY_CACHE.ttl = int(
+        settings.get('idris.repository_cache_ttl', 60))
+    TYPE_CONFIG_CACHE.max_size = int(
+        settings.get('idris.type_config_cache_size', 128))
+
     settings['tm.manager_hook'] = 'pyramid_tm.explicit_manager'
     # use pyramid_tm to hook the transaction lifecycle to the request
     config.include('pyramid_tm')
@@ -374,7 +612,13 @@ def includeme(config):
     # use pyramid_retry to retry a request when transient exceptions occur
     config.include('pyramid_retry')
 
-    engine = engine_from_config(settings, prefix='sqlalchemy.')  # , echo=True)
+    # settings for the read replica should not be passed to the primary engine
+    primary_settings = dict(
+        (key, value) for key, value in settings.items()
+        if not key.startswith('sqlalchemy.replica.'))
+    engine = engine_from_config(primary_settings,
+                                prefix='sqlalchemy.',
+                                poolclass=MeteredQueuePool)  # , echo=True)
 
     session_factory = sessionmaker()
     session_factory.configure(bind=engine, autoflush=False)
@@ -382,32 +626,130 @@ def includeme(config):
     config.registry['engine'] = engine
     config.registry['dbsession_factory'] = session_factory
 
+    # every repository has a reserved minimum of connections, and can only
+    # use a part of the connections above that
+    budget = TenantBudget(
+        tenant_pool_total(settings),
+        tenant_limits=lambda namespace: tenant_pool_limits(
+            settings, namespace)[:2])
+    tenant_engines = None
+    if asbool(settings.get('idris.pin_tenant_connections', False)):
+        # every repository gets it's own pool of connections,
+        # with the search_path set when the connection is opened
+        tenant_engines = TenantEngines(primary_settings, budget=budget)
+    config.registry['tenant_budget'] = budget
+    config.registry['tenant_engines'] = tenant_engines
+
+    replica_engine = None
+    if settings.get('sqlalchemy.replica.url'):
+        replica_settings = dict(
+            (key, value) for key, value in primary_settings.items()
+            if key.startswith('sqlalchemy.'))
+        replica_settings.update(
+            ('sqlalchemy.%s' % key[len('sqlalchemy.replica.'):], value)
+            for key, value in settings.items()
+            if key.startswith('sqlalchemy.replica.'))
+        replica_engine = engine_from_config(replica_settings,
+                                            prefix='sqlalchemy.',
+                                            poolclass=MeteredQueuePool)
+    config.registry['replica_engine'] = replica_engine
+    # after a write, the requests of a user are sent to the primary database
+    # for a number of seconds, so that the user can read his own writes
+    replica_sticky_seconds = int(
+        settings.get('idris.replica_sticky_seconds', 10))
+    # names of routes that only read from the database, GET requests for
+    # these routes can be served from the read replica
+    replica_routes = config.registry['replica_routes'] = set()
+
     config.registry['storage'] = Storage(config.registry)
 
+    change_listener = repository_change_listener(config.registry)
+
+    # names of routes that never need a repository, like static views
+    # and health checks. Requests for these routes skip the repository
+    # lookup and never check out a database connection.
+    tenantless_routes = config.registry['tenantless_routes'] = set()
+
+    def use_replica(request):
+        if replica_engine is None:
+            return False
+        if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            request.add_response_callback(
+                lambda request, response: response.set_cookie(
+                    REPLICA_STICKY_COOKIE,
+                    value='1',
+                    max_age=replica_sticky_seconds,
+                    httponly=True))
+            return False
+        return (request.matched_route is not None and
+                request.matched_route.name in replica_routes and
+                REPLICA_STICKY_COOKIE not in request.cookies)
+
     def new_dbsession(request):
-        session = get_tm_session(session_factory, request.tm)
+        if change_listener is not None:
+            change_listener.start()
         host = request.headers['Host'].split(':')[0]
-        repository = session.query(Repository).filter(
-            Repository.vhost_name == host).first()
-        if repository:
-            request.environ[
-                'idris.repository.namespace'] = repository.namespace
-            request.environ[
-                'idris.repository.config_revision'] = repository.config_revision
-            request.environ[
-                'idris.repository.settings'] = repository.settings
-            request.environ[
-                'idris.repository.app'] = repository.app
-            session.execute(
-                'SET search_path TO %s, public' % repository.namespace)
+        replica = use_replica(request)
+        if tenant_engines is None or replica:
+            session = get_tm_session(session_factory,
+                                     request.tm,
+                                     bind=replica_engine if replica else None)
+            repository = REPOSITORY_CACHE.get(host)
+            if repository is None:
+                # the lookup query checks out the connection that will
+                # be used by the rest of the request
+                repository = lookup_repository(session, host)
+                if repository:
+                    session.execute('SET search_path TO %s, public' % (
+                        repository['namespace']))
+            if repository:
+                # only check out a connection on the first actual query
+                set_search_path_on_begin(session, repository['namespace'])
+            if repository and not replica:
+                # limit the connections a repository takes from the
+                # shared pool, a request uses a single connection
+                namespace = repository['namespace']
+                try:
+                    budget.acquire(namespace,
+                                   tenant_pool_limits(settings, namespace)[2])
+                except exc.TimeoutError as err:
+                    logging.warning(str(err))
+                    raise HTTPServiceUnavailable()
+                request.add_finished_callback(
+                    lambda request: budget.release(namespace))
         else:
+            # resolve the repository outside of the request transaction,
+            # so the request session can be bound to the tenant engine
+            lookup_session = session_factory()
+            try:
+                repository = lookup_repository(lookup_session, host)
+            finally:
+                lookup_session.close()
+            bind = None
+            if repository:
+                bind = tenant_engines.get(repository['namespace'])
+            session = get_tm_session(session_factory, request.tm, bind=bind)
+
+        if repository is None:
             logging.error('No repository found for host: %s' % host)
+            return session
+        request.environ[
+            'idris.repository.namespace'] = repository['namespace']
+        request.environ[
+            'idris.repository.config_revision'] = repository['config_revision']
+        request.environ[
+            'idris.repository.settings'] = repository['settings']
+        request.environ[
+            'idris.repository.app'] = repository['app']
         return session
 
     def new_repository(request):
         if (request.path.startswith('/_') and
             not request.path.startswith('/__api__')):
             return
+        if (request.matched_route is not None and
+            request.matched_route.name in tenantless_routes):
+            return
 
         session = request.dbsession
         namespace = request.environ['idris.repository.namespace']
@@ -4,12 +4,18 @@ import json
 
 from pyramid.paster import get_appsettings
 import transaction
+import rq
 import sqlalchemy as sql
 import sqlalchemy.dialects.postgresql as postgresql
 from sqlalchemy.inspection import inspect
+from zope.sqlalchemy import mark_changed
 
 from idris import main
-from idris.models import Person, Group, Work
+from idris.models import Person, Group, Work, DownloadStats
+from idris.resources import BlobResource
+from idris.storage import RepositoryConfig
+from idris.services.download_counter import download_counter_factory
+from idris.services.download_stats import rollup_downloads
 
 
 def initialize_storage(config_uri, namespace=None):
@@ -95,6 +101,181 @@ def drop_db():
     transaction.commit()
 
 
+# columns that were added to the repository tables after the first
+# release, as (table, column, type) tuples
+ADDED_COLUMNS = [('blobs', 'transform_status', 'VARCHAR(16)')]
+
+
+def upgrade_repository(session, namespace):
+    """Add the missing columns to the tables of a repository, returns the
+    names of the added columns. This can be run more then once."""
+    added = []
+    for table, column, column_type in ADDED_COLUMNS:
+        exists = session.execute(
+            'SELECT 1 FROM information_schema.columns '
+            'WHERE table_schema = :schema AND table_name = :table '
+            'AND column_name = :column',
+            {'schema': namespace, 'table': table, 'column': column}).first()
+        if exists is None:
+            session.execute('ALTER TABLE "%s"."%s" ADD COLUMN %s %s' % (
+                namespace, table, column, column_type))
+            added.append('%s.%s' % (table, column))
+    if added:
+        mark_changed(session)
+    return added
+
+
+def upgrade_download_stats(session, namespace):
+    """Create the download_stats table of a repository, or add the unique
+    (work_id, date) index to an existing table. Returns True if the index
+    was added"""
+    table = '"%s".download_stats' % namespace
+    if session.execute('SELECT to_regclass(:table)',
+                       {'table': table}).scalar() is None:
+        DownloadStats.__table__.create(bind=session.connection())
+        mark_changed(session)
+        return True
+    index = '"%s".ix_download_stats_work_id_date' % namespace
+    if session.execute('SELECT to_regclass(:index)',
+                       {'index': index}).scalar() is not None:
+        return False
+    # overlapping rollups could insert duplicate rows, keep the newest
+    session.execute(
+        'DELETE FROM %s a USING %s b '
+        'WHERE coalesce(a.work_id, 0) = coalesce(b.work_id, 0) '
+        'AND a.date = b.date AND a.id < b.id' % (table, table))
+    session.execute(
+        'CREATE UNIQUE INDEX ix_download_stats_work_id_date '
+        'ON %s (coalesce(work_id, 0), date)' % table)
+    mark_changed(session)
+    return True
+
+
+def upgrade_db():
+    """Upgrade the tables of existing repositories to the current models,
+    run this after every deploy"""
+    if len(sys.argv) == 1:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri> [schema]\n'
+              'example: "%s development.ini test"' % (cmd, cmd))
+        sys.exit(1)
+    session, storage = initialize_storage(sys.argv[1])
+    if len(sys.argv) == 3:
+        namespaces = [sys.argv[2]]
+    else:
+        namespaces = sorted(storage.repository_info(session).keys())
+    transaction.commit()
+    for namespace in namespaces:
+        session = storage.make_session(namespace=namespace)
+        added = upgrade_repository(session, namespace)
+        if upgrade_download_stats(session, namespace):
+            added.append('download_stats.ix_download_stats_work_id_date')
+        transaction.commit()
+        print('Upgraded "%s": added %s' % (
+            namespace, ', '.join(added) or 'nothing'))
+
+
+def rollup_repository_downloads():
+    """Copy the daily download counts from redis into the download_stats
+    table, this should run daily, before the 30 day history expires."""
+    if len(sys.argv) == 1:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri> [schema]\n'
+              'example: "%s development.ini test"' % (cmd, cmd))
+        sys.exit(1)
+    session, storage = initialize_storage(sys.argv[1])
+    if len(sys.argv) == 3:
+        namespaces = [sys.argv[2]]
+    else:
+        namespaces = sorted(storage.repository_info(session).keys())
+    transaction.commit()
+    for namespace in namespaces:
+        session = storage.make_session(namespace=namespace)
+        upgrade_download_stats(session, namespace)
+        downloads = download_counter_factory(storage.registry, namespace)
+        days = rollup_downloads(session, downloads)
+        transaction.commit()
+        print('Rolled up %s days of downloads in "%s"' % (days, namespace))
+
+
+def rotate_repository_downloads():
+    """Merge the unique download HLLs of the last 30 days. The first
+    download of a day does this as well, schedule this to run once a day,
+    shortly after midnight UTC, to not delay that download."""
+    if len(sys.argv) == 1:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri> [schema]\n'
+              'example: "%s development.ini test"' % (cmd, cmd))
+        sys.exit(1)
+    session, storage = initialize_storage(sys.argv[1])
+    if len(sys.argv) == 3:
+        namespaces = [sys.argv[2]]
+    else:
+        namespaces = sorted(storage.repository_info(session).keys())
+    transaction.commit()
+    for namespace in namespaces:
+        downloads = download_counter_factory(storage.registry, namespace)
+        downloads.rotate_hll()
+        print('Rotated unique downloads in "%s"' % namespace)
+
+
+# the application registry of the transform_worker process
+WORKER_REGISTRY = None
+
+
+def transform_blob_job(namespace, api_host_url, app_name, blob_id):
+    """Transform and finalize a blob, this job is queued by
+    BlobStore.queue_transform and run by the transform_worker"""
+    storage = WORKER_REGISTRY['storage']
+
+    def load_blob():
+        session = storage.make_session(namespace=namespace)
+        repository = RepositoryConfig(WORKER_REGISTRY,
+                                      session,
+                                      namespace,
+                                      api_host_url,
+                                      app_name)
+        return repository, BlobResource(WORKER_REGISTRY, session, blob_id)
+
+    with transaction.manager:
+        repository, blob = load_blob()
+        if blob.model is None:
+            return
+        blob.model.transform_status = 'running'
+        blob.put()
+    try:
+        with transaction.manager:
+            repository, blob = load_blob()
+            repository.blob.transform_blob(blob)
+            repository.blob.finalize_blob(blob)
+    except Exception:
+        with transaction.manager:
+            repository, blob = load_blob()
+            blob.model.transform_status = 'failed'
+            blob.put()
+        raise
+    return blob_id
+
+
+def transform_worker():
+    """Run a worker that processes the queued blob transforms,
+    start as many workers as needed"""
+    global WORKER_REGISTRY
+    if len(sys.argv) == 1:
+        cmd = os.path.basename(sys.argv[0])
+        print('usage: %s <config_uri>\n'
+              'example: "%s development.ini"' % (cmd, cmd))
+        sys.exit(1)
+    session, storage = initialize_storage(sys.argv[1])
+    transaction.commit()
+    queue = storage.registry['transform_queue']
+    if queue is None:
+        print('Error: transform_queue.url is not configured')
+        sys.exit(1)
+    WORKER_REGISTRY = storage.registry
+    rq.Worker([queue], connection=queue.connection).work()
+
+
 def export_repository():
     if len(sys.argv) == 1:
         cmd = os.path.basename(sys.argv[0])
@@ -1,7 +1,13 @@
 import os
 import json
+import atexit
+import math
+import time
 import codecs
+import hashlib
 import binascii
+import threading
+from collections import OrderedDict
 from infinity import is_infinite
 
 import colander
@@ -51,6 +57,177 @@ ErrorStatus = colander.SchemaNode(colander.String(),
                                   validator=colander.OneOf(['error']))
 
 
+class LRUCache(object):
+    """Thread safe, size bounded mapping with optional expiration.
+
+    When more then `max_size` items are stored, the least recently used
+    item is evicted. If a `ttl` (in seconds) is given, items older then
+    the ttl are treated as missing.
+    """
+
+    def __init__(self, max_size=128, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._items[key]
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        expires = None
+        if ttl:
+            expires = time.monotonic() + ttl
+        with self._lock:
+            self._items[key] = (value, expires)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            return self._items.pop(key, None) is not None
+
+    def delete_matching(self, predicate):
+        "remove all items for which predicate(key, value) is true"
+        with self._lock:
+            keys = [k for k, (v, _) in self._items.items() if predicate(k, v)]
+            for key in keys:
+                del self._items[key]
+        return len(keys)
+
+    def purge_expired(self):
+        "remove all expired items, returns the number of removed items"
+        now = time.monotonic()
+        with self._lock:
+            keys = [k for k, (_, expires) in self._items.items()
+                    if expires is not None and expires < now]
+            for key in keys:
+                del self._items[key]
+        return len(keys)
+
+    def keys(self):
+        "a snapshot of the stored keys, least recently used first"
+        with self._lock:
+            return list(self._items.keys())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+
+class HyperLogLog(object):
+    """Approximate counter of unique values, with the same precision
+    as the Redis HyperLogLog (2 ** 14 registers, 0.81% standard error).
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        "Add a value, returns True if the estimated count changed"
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf8')
+        hashed = int.from_bytes(
+            hashlib.blake2b(value, digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        rest = (hashed << self.precision) & 0xFFFFFFFFFFFFFFFF
+        rank = min(64 - rest.bit_length(), 64 - self.precision) + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+            return True
+        return False
+
+    def count(self):
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(
+            2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # use linear counting for small cardinalities
+            estimate = size * math.log(size / zeros)
+        return int(round(estimate))
+
+    def merge(self, *others):
+        "Add the values of other HyperLogLogs to this one"
+        for other in others:
+            self.registers = bytearray(
+                max(a, b) for a, b in zip(self.registers, other.registers))
+
+
+class BackgroundWorker(object):
+    """Base class of process wide workers that run in a daemon thread.
+
+    The thread is started on first use in every process, so workers
+    created before gunicorn forks get their own thread in each worker.
+    Subclasses implement `run`, and `drain` if pending work has to be
+    finished on shutdown.
+    """
+
+    thread_name = 'background-worker'
+
+    def __init__(self):
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        "Start the worker thread, if it is not running in this process"
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self.run,
+                                      name=self.thread_name,
+                                      daemon=True)
+            thread.start()
+
+    def run(self):
+        raise NotImplementedError
+
+    def drain(self):
+        "Finish the pending work, returns the number of items written"
+        return 0
+
+
+BACKGROUND_WORKERS = []
+
+
+def register_background_worker(worker):
+    "Drain the worker on exit and from the gunicorn worker_exit hook"
+    BACKGROUND_WORKERS.append(worker)
+    return worker
+
+
+def drain_background_workers(worker_class=BackgroundWorker):
+    """Drain all registered workers of this process that are instances of
+    worker_class, returns the number of items written"""
+    return sum(worker.drain() for worker in BACKGROUND_WORKERS
+               if isinstance(worker, worker_class))
+
+
+atexit.register(drain_background_workers)
+
+
 WEBINDEXTEMPLATES = {}
 
 def load_web_index_template(filename='index.html', config=None):
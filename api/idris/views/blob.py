@@ -42,6 +42,8 @@ class BlobFinalizedSchema(BlobSchema):
     text = colander.SchemaNode(colander.String(),
                                missing=colander.drop)
     finalized = colander.SchemaNode(colander.Boolean(),  missing=colander.drop)
+    transform_status = colander.SchemaNode(colander.String(),
+                                           missing=colander.drop)
 
 class BlobBulkRequestSchema(colander.MappingSchema,
                             JsonMappingSchemaSerializerMixin):
@@ -140,12 +142,9 @@ class BlobRecordAPI(object):
             self.request.errors.add(
                 'body', '', 'blob has not been finalized')
             return
-        self.response.content_type = self.context.model.format
-        self.content_length = self.context.model.bytes
-        blobstore.serve_blob(self.request,
-                             self.response,
-                             self.context)
-        return self.response
+        return blobstore.serve_blob(self.request,
+                                    self.response,
+                                    self.context)
 
     @view(
         permission='finalize',
@@ -167,8 +166,9 @@ class BlobRecordAPI(object):
             self.request.errors.add(
                 'body', '', 'file is missing (not uploaded yet?)')
             return
-        blobstore.transform_blob(self.context)
-        blobstore.finalize_blob(self.context)
+        if not blobstore.queue_transform(self.context):
+            blobstore.transform_blob(self.context)
+            blobstore.finalize_blob(self.context)
         return self.context.model.to_dict()
 
 
@@ -186,7 +186,12 @@ def blob_upload_local_view(request):
     if blobstore.blob_exists(request.context.model.id):
         raise HTTPPreconditionFailed()
 
-    blobstore.receive_blob(request, request.context)
+    try:
+        blobstore.receive_blob(request, request.context)
+    except StorageError as err:
+        request.errors.status = 400
+        request.errors.add('body', err.location, str(err))
+        return
     request.context.put()
     return BlobSchema().to_json(request.context.model.to_dict())
 
@@ -205,11 +210,23 @@ def blob_transform_view(request):
     if not blobstore.blob_exists(request.context.model.id):
         raise HTTPPreconditionFailed('File is missing')
 
-    blobstore.transform_blob(request.context)
-    blobstore.finalize_blob(request.context)
+    if not blobstore.queue_transform(request.context):
+        blobstore.transform_blob(request.context)
+        blobstore.finalize_blob(request.context)
     return request.context.model.to_dict()
 
 
+@blob_transform.get(permission='finalize')
+def blob_transform_status_view(request):
+    "Poll the status of a queued transform"
+    model = request.context.model
+    return {'id': model.id,
+            'transform_status': model.transform_status,
+            'transform_name': model.transform_name,
+            'finalized': bool(model.finalized),
+            'status': 'ok'}
+
+
 blob_download = Service(name='BlobDownload',
                         path='/api/v1/blob/download/{id}',
                         factory=ResourceFactory(BlobResource),
@@ -222,13 +239,9 @@ def blob_download_local_view(request):
     blobstore = request.repository.blob
     if not blobstore.blob_exists(request.context.model.id):
         raise HTTPPreconditionFailed('File is missing')
-    response = request.response
-    response.content_type = request.context.model.format
-    response.content_length = request.context.model.bytes
-    request.repository.blob.serve_blob(request,
-                                       response,
-                                       request.context)
-    return response
+    return blobstore.serve_blob(request,
+                                request.response,
+                                request.context)
 
 blob_preview = Service(name='BlobPreview',
                        path='/api/v1/blob/preview/{id}',
@@ -242,10 +255,8 @@ def blob_preview_local_view(request):
     preview_kind =  request.context.model.info.get('preview_blob')
     if not preview_kind:
         raise HTTPPreconditionFailed('Preview is missing')
-    request.repository.blob.backend.serve_preview_blob(request,
-                                                       request.response,
-                                                       request.context)
-    return request.response
+    return request.repository.blob.backend.serve_preview_blob(
+        request, request.response, request.context)
 
 blob_bulk = Service(
     name='BlobBulk',
@@ -6,6 +6,7 @@ from pyramid.view import view_config
 from pyramid.httpexceptions import HTTPNotFound
 
 from idris.interfaces import IAppRoot
+from idris.pool import pool_stats, redis_pool
 
 @view_config(context=IAppRoot, name='debug_log')
 def debug_log(request):
@@ -22,24 +23,46 @@ def debug_log(request):
 
 @view_config(context=IAppRoot, name='debug_db')
 def debug_db(request):
-    pool = request.registry['engine'].pool
-    info = ("Pool size: %d  Connections in pool: %d "\
-            "Current Overflow: %d Current Checked out "\
-            "connections: %d" % (pool.size(),
-                                 pool.checkedin(),
-                                 pool.overflow(),
-                                 pool.checkedout()))
+    pools = [('default', request.registry['engine'].pool)]
+    if request.registry.get('replica_engine') is not None:
+        pools.append(('replica', request.registry['replica_engine'].pool))
+    tenant_engines = request.registry.get('tenant_engines')
+    if tenant_engines is not None:
+        pools.extend((namespace, engine.pool)
+                     for namespace, engine in tenant_engines.items())
+    lines = []
+    for name, pool in pools:
+        stats = pool_stats(pool)
+        lines.append('%s: %s' % (name, ' '.join(
+            '%s=%s' % (key, stats[key]) for key in sorted(stats))))
+    budget = request.registry.get('tenant_budget')
+    if budget is not None:
+        stats = budget.stats()
+        lines.append('budget: %s' % ' '.join(
+            '%s=%s' % (key, stats[key]) for key in sorted(stats)))
+    pool = redis_pool(request.registry)
+    if pool is not None:
+        stats = pool.stats()
+        lines.append('redis: %s' % ' '.join(
+            '%s=%s' % (key, stats[key]) for key in sorted(stats)))
 
     request.response.content_type = 'text/plain'
-    request.response.write(info)
+    request.response.write('\n'.join(lines))
+    return request.response
+
+@view_config(context=IAppRoot, name='debug_cache')
+def debug_cache(request):
+    lines = ['%s: %s' % (key, size)
+             for key, size in request.repository.cache.key_sizes()]
+    request.response.content_type = 'text/plain'
+    request.response.write('\n'.join(lines))
     return request.response
 
 @view_config(context=IAppRoot, name='debug_repo')
 def debug_repo(request):
-    from idris.storage import REPOSITORY_CONFIG
+    from idris.storage import TYPE_CONFIG_CACHE
+    cached = TYPE_CONFIG_CACHE.get(request.repository.namespace)
     request.response.content_type = 'application/json'
     request.response.write(
-        json.dumps(
-            REPOSITORY_CONFIG.get(request.repository.namespace,
-                                  {})).encode('utf8'))
+        json.dumps(dict([cached] if cached else [])).encode('utf8'))
     return request.response
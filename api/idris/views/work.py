@@ -1,4 +1,5 @@
 from intervals import DateInterval
+import base64
 import datetime
 
 import colander
@@ -9,6 +10,7 @@ from sqlalchemy.orm import Load
 from cornice.resource import resource, view
 from cornice.validators import colander_validator
 from cornice import Service
+from pyramid.httpexceptions import HTTPNotFound
 
 from idris.models import Work
 from idris.resources import ResourceFactory, WorkResource, GroupResource
@@ -321,6 +323,29 @@ class WorkSearchRequestSchema(colander.MappingSchema):
                                     missing=20)
 
 
+class WorkHistoryRequestSchema(colander.MappingSchema):
+    @colander.instantiate()
+    class querystring(colander.MappingSchema):
+        log = colander.SchemaNode(
+            colander.String(),
+            validator=colander.Regex(r'^[a-z][a-z0-9_]*$'),
+            missing='usage')
+        action = colander.SchemaNode(colander.String(),
+                                     missing=colander.drop)
+        start_date = colander.SchemaNode(colander.Date(), missing=None)
+        end_date = colander.SchemaNode(colander.Date(), missing=None)
+        summary = colander.SchemaNode(
+            colander.String(),
+            validator=colander.OneOf(['day', 'month', 'year']),
+            missing=colander.drop)
+        cursor = colander.SchemaNode(colander.String(),
+                                     missing=colander.drop)
+        limit = colander.SchemaNode(colander.Int(),
+                                    default=100,
+                                    validator=colander.Range(1, 1000),
+                                    missing=100)
+
+
 class WorkBulkRequestSchema(colander.MappingSchema):
     @colander.instantiate()
     class records(colander.SequenceSchema):
@@ -688,6 +713,95 @@ def work_search_view(request):
             'offset': offset,
             'status': 'ok'}
 
+work_history = Service(
+    name='WorkHistory',
+    path='/api/v1/work/records/{id}/history',
+    factory=ResourceFactory(WorkResource),
+    api_security=[{'jwt': []}],
+    tags=['work'],
+    cors_origins=('*', ),
+    schema=WorkHistoryRequestSchema(),
+    validators=(colander_validator,),
+    response_schemas={
+        '200': OKStatusResponseSchema(description='Ok'),
+        '400': ErrorResponseSchema(description='Bad Request'),
+        '401': ErrorResponseSchema(description='Unauthorized'),
+        '403': ErrorResponseSchema(description='Forbidden')})
+
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encode_history_cursor(created, id):
+    """Returns an opaque cursor for the (created, id) of a history entry,
+    created is stored as microseconds since the epoch in UTC"""
+    if created.tzinfo is not None:
+        created = created.astimezone(
+            datetime.timezone.utc).replace(tzinfo=None)
+    micros = (created - EPOCH) // datetime.timedelta(microseconds=1)
+    return base64.urlsafe_b64encode(
+        ('%s:%s' % (micros, id)).encode('ascii')).decode('ascii')
+
+
+def decode_history_cursor(cursor):
+    "Returns the (created, id) of a cursor, raises ValueError if invalid"
+    micros, id = base64.urlsafe_b64decode(
+        cursor.encode('ascii')).decode('ascii').split(':')
+    return (EPOCH + datetime.timedelta(microseconds=int(micros)), int(id))
+
+
+@work_history.get(permission='edit')
+def work_history_view(request):
+    """Audit log entries of a work, newest first, in pages of `limit`
+    entries. Pass the returned cursor to retrieve the next page, or
+    a summary period to retrieve the totals per day, month or year."""
+    qs = request.validated['querystring']
+    auditlog = request.repository.auditlog
+    if auditlog is None:
+        raise HTTPNotFound('No audit log configured')
+    params = dict(log_name=qs['log'],
+                  work_id=request.context.model.id,
+                  actions=[a for a in qs.get('action', '').split(',') if a],
+                  start=None,
+                  end=None)
+    if qs['start_date']:
+        params['start'] = datetime.datetime.combine(
+            qs['start_date'], datetime.time())
+    if qs['end_date']:
+        params['end'] = datetime.datetime.combine(
+            qs['end_date'] + datetime.timedelta(days=1), datetime.time())
+    has_log = auditlog.has_log(qs['log'])
+    if 'summary' in qs:
+        summary = []
+        if has_log:
+            summary = list(auditlog.work_history_summary(
+                period=qs['summary'], **params))
+        return {'summary': summary,
+                'status': 'ok'}
+    if 'cursor' in qs:
+        try:
+            params['before'] = decode_history_cursor(qs['cursor'])
+        except ValueError:
+            request.errors.status = 400
+            request.errors.add('querystring', 'cursor', 'Invalid cursor')
+            return
+    entries = []
+    if has_log:
+        # retrieve one extra entry to find out if there is a next page
+        entries = list(auditlog.work_history(limit=qs['limit'] + 1,
+                                             **params))
+    cursor = None
+    if len(entries) > qs['limit']:
+        entries = entries[:qs['limit']]
+        cursor = encode_history_cursor(entries[-1]['created'],
+                                       entries[-1]['id'])
+    for entry in entries:
+        entry['created'] = entry['created'].isoformat()
+    return {'entries': entries,
+            'cursor': cursor,
+            'limit': qs['limit'],
+            'status': 'ok'}
+
 @resource(
     name='WorkIds',
     collection_path='/api/v1/work/ids',
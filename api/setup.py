@@ -39,7 +39,11 @@ setup(name='idris',
       [console_scripts]
       initialize_db = idris.tools:initialize_db
       drop_db = idris.tools:drop_db
+      upgrade_db = idris.tools:upgrade_db
       bigquery_schema = idris.tools:bigquery_schema
       export_repository = idris.tools:export_repository
+      rollup_downloads = idris.tools:rollup_repository_downloads
+      rotate_downloads = idris.tools:rotate_repository_downloads
+      transform_worker = idris.tools:transform_worker
       """,
       paster_plugins=['pyramid'])
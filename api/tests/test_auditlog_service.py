@@ -1,10 +1,23 @@
 import os
 import time
 import uuid
+import datetime
+import threading
 
 import pytest
+import transaction
 
-from idris.services.auditlog import auditlog_factory
+from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+from idris.services.auditlog import (auditlog_factory,
+                                     create_audit_logs,
+                                     drain_auditlog_writers,
+                                     AuditLogWriter,
+                                     BQAuditLog,
+                                     BQ_CLIENTS,
+                                     KNOWN_LOGS)
+from idris.views.work import encode_history_cursor, decode_history_cursor
 from core import BaseTest, no_google_credentials
 
 
@@ -64,3 +77,329 @@ class CacheServiceTest(BaseTest):
                                   value=str(uuid.uuid4()))
         assert succeeded is False
         assert self.log.has_log('foobar') is False
+
+
+class FakeAuditLog(object):
+    ds_name = 'unittest'
+
+    def __init__(self, failures=0):
+        self.logs = {}
+        self.failures = failures
+
+    def has_log(self, name):
+        return name in self.logs
+
+    def create_log(self, name):
+        self.logs[name] = []
+        return True
+
+    def append_many(self, log_name, rows):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('Service Unavailable')
+        if log_name not in self.logs:
+            return False
+        self.logs[log_name].append(rows)
+        return True
+
+
+class FakeBigQueryClient(object):
+
+    def __init__(self):
+        self.tables = {}
+        self.inserts = []
+
+    def dataset(self, name):
+        return bigquery.DatasetReference('unittest', name)
+
+    def get_table(self, table_ref):
+        if table_ref.table_id not in self.tables:
+            raise NotFound(table_ref.table_id)
+        return self.tables[table_ref.table_id]
+
+    def update_table(self, table, fields):
+        self.tables[table.table_id] = table
+
+    def insert_rows(self, table_ref, rows, selected_fields, row_ids):
+        self.inserts.append((table_ref.table_id, rows, row_ids))
+        return []
+
+
+class BQAuditLogRowIdTest(BaseTest):
+
+    def setUp(self):
+        super(BQAuditLogRowIdTest, self).setUp()
+        self.client = BQ_CLIENTS['fake.json'] = FakeBigQueryClient()
+        self.log = BQAuditLog('bigquery://#fake.json', 'unittest')
+
+    def tearDown(self):
+        BQ_CLIENTS.pop('fake.json')
+        KNOWN_LOGS.discard(('unittest', 'test'))
+        super(BQAuditLogRowIdTest, self).tearDown()
+
+    def test_rows_have_a_unique_id(self):
+        # a log that was created before rows had an id
+        table_ref = self.log.table_ref('test')
+        self.client.tables['test_auditlog'] = bigquery.Table(
+            table_ref, schema=self.log.schema[:-1])
+        created = datetime.datetime(2019, 3, 1, 12)
+        assert self.log.append('test', 'download', 1, 'me', created=created)
+        assert self.log.append('test', 'download', 1, 'me', created=created)
+        schema = self.client.tables['test_auditlog'].schema
+        assert [f.name for f in schema][-1] == 'id'
+        (_, [first], [first_id]), (_, [second], [second_id]) = (
+            self.client.inserts)
+        assert first[:-1] == second[:-1]
+        assert first[-1] != second[-1]
+        assert [first_id, second_id] == [str(first[-1]), str(second[-1])]
+
+
+class AuditLogWriterTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(AuditLogWriterTest, self).app_settings()
+        settings['auditlog.async'] = 'true'
+        settings['auditlog.batch_size'] = '3'
+        settings['auditlog.batch_age'] = '100'
+        return settings
+
+    def setUp(self):
+        super(AuditLogWriterTest, self).setUp()
+        self.writer = self.app.registry['auditlog_writer']
+        self.writer.retry_delay = 0.01
+
+    def test_rows_are_written_in_batches(self):
+        log = FakeAuditLog()
+        for i in range(4):
+            assert self.writer.put(log, 'usage', ('download', i))
+        for i in range(20):
+            if sum(len(rows) for rows in log.logs.get('usage', [])) == 4:
+                break
+            time.sleep(0.05)
+        # the missing log is created, the last row is written
+        # when the batch is old enough
+        assert log.logs['usage'] == [[('download', 0),
+                                      ('download', 1),
+                                      ('download', 2)],
+                                     [('download', 3)]]
+
+    def test_failed_writes_are_retried(self):
+        log = FakeAuditLog(failures=2)
+        log.create_log('usage')
+        self.writer._pid = os.getpid()  # no background thread
+        self.writer.put(log, 'usage', ('download', 1))
+        assert drain_auditlog_writers() == 1
+        assert log.logs['usage'] == [[('download', 1)]]
+        log.failures = 10
+        self.writer.put(log, 'usage', ('download', 2))
+        assert self.writer.drain() == 0
+
+    def test_full_queue_drops_entries(self):
+        writer = AuditLogWriter(queue_size=1)
+        writer._pid = os.getpid()
+        log = FakeAuditLog()
+        assert writer.put(log, 'usage', ('download', 1))
+        assert writer.put(log, 'usage', ('download', 2)) is False
+
+    def test_writer_thread_is_started_once_per_process(self):
+        threads = lambda: len([t for t in threading.enumerate()
+                               if t.name == 'auditlog-writer'])
+        before = threads()
+        writer = AuditLogWriter()
+        writer.start()
+        writer.start()
+        assert threads() == before + 1
+        writer._pid = None  # as seen from a forked process
+        writer.start()
+        assert threads() == before + 2
+
+
+class PGAuditLogTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(PGAuditLogTest, self).app_settings()
+        settings['auditlog.url'] = 'postgresql://'
+        return settings
+
+    def setUp(self):
+        super(PGAuditLogTest, self).setUp()
+        self.log = auditlog_factory(self.app.registry, 'unittest')
+
+    def test_create_table(self):
+        assert self.log.has_log('test') is False
+        assert self.log.create_log('test')
+        assert self.log.has_log('test') is True
+        with pytest.raises(ValueError):
+            self.log.has_log('test"; drop table')
+
+    def test_create_log_creates_the_schema(self):
+        # with a separate audit log database, the schema does not exist
+        log = auditlog_factory(self.app.registry, 'auditlog_only')
+        try:
+            assert log.create_log('test')
+            assert log.has_log('test') is True
+        finally:
+            log._execute('DROP SCHEMA auditlog_only CASCADE')
+
+    def test_plain_table_on_older_servers(self):
+        self.log._partitioned = lambda: False
+        assert self.log.create_log('plain')
+        for month in (1, 2):
+            assert self.log.append('plain', 'download', 1, month,
+                                   created=datetime.datetime(2019, month, 1))
+        assert self.log._execute(
+            "SELECT relkind FROM pg_class WHERE relname = 'plain_auditlog'"
+            ) == [('r',)]
+        entries = list(self.log.work_history('plain', 1))
+        assert [e['user_id'] for e in entries] == ['2', '1']
+
+    def test_append_and_retrieve(self):
+        assert self.log.create_log('test')
+        work_id = 12345
+        # the entries span several monthly partitions
+        dates = [datetime.datetime(2018, 12, 30),
+                 datetime.datetime(2019, 1, 2),
+                 datetime.datetime(2018, 11, 1),
+                 datetime.datetime(2018, 12, 31)]
+        for i, created in enumerate(dates):
+            assert self.log.append('test',
+                                   'download',
+                                   work_id,
+                                   i,
+                                   message='this is test %s' % i,
+                                   created=created)
+        assert self.log.append('test', 'download', 54321, 0)
+        entries = list(self.log.work_history('test', work_id))
+        assert [e['user_id'] for e in entries] == ['1', '3', '0', '2']
+        assert entries[0]['message'] == 'this is test 1'
+        assert entries[0]['context_id'] is None
+        # keyset pagination
+        entries = list(self.log.work_history('test', work_id, limit=3))
+        assert len(entries) == 3
+        last = entries[-1]
+        entries = list(self.log.work_history(
+            'test', work_id, before=(last['created'], last['id'])))
+        assert [e['user_id'] for e in entries] == ['2']
+
+    def test_history_filters_and_summary(self):
+        self.log.create_log('test')
+        for day, user, action in [(1, 'a', 'download'),
+                                  (1, 'a', 'download'),
+                                  (1, 'b', 'view'),
+                                  (2, 'b', 'download'),
+                                  (15, 'c', 'download')]:
+            self.log.append('test', action, 1, user,
+                            created=datetime.datetime(2019, 3, day, 12))
+        entries = list(self.log.work_history('test', 1, actions=['view']))
+        assert [e['user_id'] for e in entries] == ['b']
+        entries = list(self.log.work_history(
+            'test', 1,
+            start=datetime.datetime(2019, 3, 2),
+            end=datetime.datetime(2019, 3, 15)))
+        assert [e['user_id'] for e in entries] == ['b']
+        summary = list(self.log.work_history_summary(
+            'test', 1, actions=['download']))
+        assert summary == [{'period': '2019-03-01', 'total': 2, 'unique': 1},
+                           {'period': '2019-03-02', 'total': 1, 'unique': 1},
+                           {'period': '2019-03-15', 'total': 1, 'unique': 1}]
+        summary = list(self.log.work_history_summary(
+            'test', 1, period='month'))
+        assert summary == [{'period': '2019-03', 'total': 5, 'unique': 3}]
+
+    def test_history_api(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        work_id = self.api.post_json('/api/v1/work/records',
+                                     {'title': 'A test article.',
+                                      'issued': '2018-02-26',
+                                      'type': 'article'},
+                                     headers=headers).json['id']
+        url = '/api/v1/work/records/%s/history' % work_id
+        for day in range(1, 6):
+            self.log.append('usage', 'download', work_id, 'a',
+                            created=datetime.datetime(2019, 3, day))
+        out = self.api.get(url, {'limit': 2}, headers=headers)
+        assert [e['created'][:10] for e in out.json['entries']] == [
+            '2019-03-05', '2019-03-04']
+        out = self.api.get(url,
+                           {'limit': 2, 'cursor': out.json['cursor']},
+                           headers=headers)
+        assert [e['created'][:10] for e in out.json['entries']] == [
+            '2019-03-03', '2019-03-02']
+        out = self.api.get(url,
+                           {'limit': 2, 'cursor': out.json['cursor']},
+                           headers=headers)
+        assert len(out.json['entries']) == 1
+        assert out.json['cursor'] is None
+        out = self.api.get(url,
+                           {'start_date': '2019-03-02',
+                            'end_date': '2019-03-03',
+                            'summary': 'day'},
+                           headers=headers)
+        assert [s['period'] for s in out.json['summary']] == [
+            '2019-03-02', '2019-03-03']
+        self.api.get(url, {'cursor': 'foo'}, headers=headers, status=400)
+        self.api.get(url, {'log': 'foo"'}, headers=headers, status=400)
+
+    def test_history_api_on_missing_log(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        work_id = self.api.post_json('/api/v1/work/records',
+                                     {'title': 'A test article.',
+                                      'issued': '2018-02-26',
+                                      'type': 'article'},
+                                     headers=headers).json['id']
+        url = '/api/v1/work/records/%s/history' % work_id
+        out = self.api.get(url, {'log': 'missing', 'summary': 'day'},
+                           headers=headers)
+        assert out.json == {'summary': [], 'status': 'ok'}
+        out = self.api.get(url, {'log': 'missing'}, headers=headers)
+        assert out.json['entries'] == []
+        assert out.json['cursor'] is None
+
+    def test_history_cursor(self):
+        created = datetime.datetime(2019, 3, 1, 12, 30, 15, 123456)
+        cursor = encode_history_cursor(created, 42)
+        assert decode_history_cursor(cursor) == (created, 42)
+        # timestamps with a timezone are stored in UTC
+        aware = datetime.datetime(2019, 3, 1, 13, 30, 15, 123456,
+                                  tzinfo=datetime.timezone(
+                                      datetime.timedelta(hours=1)))
+        cursor = encode_history_cursor(aware, -42)
+        assert decode_history_cursor(cursor) == (created, -42)
+        with pytest.raises(ValueError):
+            decode_history_cursor('foo')
+
+    def test_logs_are_created_with_the_repository(self):
+        assert self.log.has_log('usage') is True
+        assert create_audit_logs(self.app.registry, 'unittest') == []
+
+    def test_failed_audit_log_creation_does_not_fail_the_repository(self):
+        self.app.registry['audit_logs'].add('invalid-name')
+        try:
+            self.storage.drop_repository(self.session, 'unittest')
+            transaction.commit()
+            self.storage.create_repository(self.session,
+                                           'unittest',
+                                           'unittest.localhost',
+                                           'base')
+            self.storage.initialize_repository(self.session,
+                                               'unittest',
+                                               'admin',
+                                               'admin')
+            transaction.commit()
+        finally:
+            self.app.registry['audit_logs'].discard('invalid-name')
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+
+    def test_append_non_existing_table(self):
+        assert self.log.append('foobar', 'download', 12345, 0) is False
+        assert self.log.has_log('foobar') is False
+
+    def test_async_writes_create_the_log(self):
+        writer = AuditLogWriter()
+        writer._pid = os.getpid()  # no background thread
+        self.log._writer = writer
+        for i in range(3):
+            assert self.log.append('usage', 'download', 1, i)
+        assert writer.drain() == 3
+        assert len(list(self.log.work_history('usage', 1))) == 3
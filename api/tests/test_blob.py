@@ -1,6 +1,15 @@
 import os
 import json
 import codecs
+import hashlib
+
+import rq
+import redis
+import transaction
+from zope.interface import implementer
+
+from idris import tools
+from idris.interfaces import IBlobStoreBackend, IBlobTransform
 from core import BaseTest, no_google_credentials
 
 
@@ -33,6 +42,38 @@ class BlobStorageTest(BaseTest):
                                 status=200)
         assert out.json['checksum'] == '702edca0b2181c15d457eacac39de39b'
 
+    def test_blob_upload_is_streamed_in_chunks(self):
+        content = os.urandom(1000)
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.post_json('/api/v1/blob/records',
+                                 {'name': 'test.bin',
+                                  'bytes': len(content),
+                                  'format': 'application/octet-stream'},
+                                 headers=headers,
+                                 status=201)
+        blob_id = out.json['id']
+        upload_url = out.json['upload_url']
+        upload_headers = headers.copy()
+        upload_headers['Content-Type'] = 'application/octet-stream'
+        backend = self.app.registry.queryUtility(IBlobStoreBackend, 'local')
+        chunk_size = backend.chunk_size
+        backend.chunk_size = 64
+        try:
+            # a truncated upload is rejected, and not stored
+            out = self.api.put(upload_url,
+                               content[:500],
+                               headers=upload_headers,
+                               status=400)
+            assert out.json['errors'][0]['description'] == (
+                'Expected 1000 bytes, received 500 bytes')
+            out = self.api.put(upload_url,
+                               content,
+                               headers=upload_headers,
+                               status=200)
+        finally:
+            backend.chunk_size = chunk_size
+        assert out.json['checksum'] == hashlib.md5(content).hexdigest()
+
     @no_google_credentials
     def test_pdf_transforms(self):
         content = open(os.path.join(os.path.dirname(__file__),
@@ -75,6 +116,9 @@ class BlobStorageTest(BaseTest):
         out = self.api.get(preview_url)
         assert out.content_type == 'image/jpeg'
         assert out.body[:10].endswith(b'JFIF')
+        assert out.headers['ETag'] == (
+            '"3d0c5a07a69b6a9b3615a44881be654c-thumb"')
+        assert 'immutable' in out.headers['Cache-Control']
 
 
     def test_bulk_blob_upload(self):
@@ -166,3 +210,204 @@ class BlobStorageTest(BaseTest):
                            status=200)
         assert out.content_type == 'text/plain'
         assert out.body == b'This is a test!'
+        assert out.headers['Accept-Ranges'] == 'bytes'
+        assert out.headers['ETag'] == '"702edca0b2181c15d457eacac39de39b"'
+        assert out.headers['Cache-Control'] == 'private, no-cache'
+        # the blob is not sent again when the etag matches
+        cached_headers = headers.copy()
+        cached_headers['If-None-Match'] = out.headers['ETag']
+        out = self.api.get('/api/v1/blob/records/%s' % blob_id,
+                           headers=cached_headers,
+                           status=304)
+        assert out.body == b''
+        # a byte range is served as partial content
+        range_headers = headers.copy()
+        range_headers['Range'] = 'bytes=5-8'
+        out = self.api.get('/api/v1/blob/records/%s' % blob_id,
+                           headers=range_headers,
+                           status=206)
+        assert out.body == b'is a'
+        assert out.headers['Content-Range'] == 'bytes 5-8/15'
+        range_headers['Range'] = 'bytes=20-'
+        self.api.get('/api/v1/blob/records/%s' % blob_id,
+                     headers=range_headers,
+                     status=416)
+
+
+class BlobOffloadTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(BlobOffloadTest, self).app_settings()
+        settings['idris.blob_delivery'] = 'x-accel-redirect'
+        return settings
+
+    def add_blob(self, headers, content):
+        out = self.api.post_json('/api/v1/blob/records',
+                                 {'name': 'test.txt',
+                                  'bytes': len(content),
+                                  'format': 'text/plain'},
+                                 headers=headers,
+                                 status=201)
+        blob_id = out.json['id']
+        upload_headers = headers.copy()
+        upload_headers['Content-Type'] = 'text/plain'
+        self.api.put(out.json['upload_url'],
+                     content,
+                     headers=upload_headers,
+                     status=200)
+        self.api.put('/api/v1/blob/records/%s' % blob_id,
+                     headers=headers,
+                     status=200)
+        self.api.post_json(
+            '/api/v1/work/records',
+            {'title': 'A test article.',
+             'issued': '2018-02-26',
+             'type': 'article',
+             'expressions': [{'type': 'publication',
+                              'format': 'manuscript',
+                              'access': 'public',
+                              'name': 'test.txt',
+                              'blob_id': blob_id}]},
+            headers=headers,
+            status=201)
+        return blob_id
+
+    def test_download_is_sent_by_the_web_server(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        blob_id = self.add_blob(headers, b'This is a test!')
+        out = self.api.get('/api/v1/blob/records/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        assert out.body == b''
+        assert out.content_type == 'text/plain'
+        assert out.headers['X-Accel-Redirect'] == (
+            '/_blobs/unittest/primary/%0.3d/%s' % (
+                int(str(blob_id)[-3:]), blob_id))
+        assert 'filename=test.txt' in out.headers['Content-Disposition']
+        headers['If-None-Match'] = out.headers['ETag']
+        out = self.api.get('/api/v1/blob/records/%s' % blob_id,
+                           headers=headers,
+                           status=304)
+        assert 'X-Accel-Redirect' not in out.headers
+
+    def test_x_sendfile_header_has_the_file_path(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        blob_id = self.add_blob(headers, b'This is a test!')
+        self.app.registry.settings['idris.blob_delivery'] = 'x-sendfile'
+        out = self.api.get('/api/v1/blob/records/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        path = out.headers['X-Sendfile']
+        assert os.path.isabs(path)
+        with open(path, 'rb') as fp:
+            assert fp.read() == b'This is a test!'
+
+
+@implementer(IBlobTransform)
+class WordCountTransform(object):
+    name = 'WordCount 1.0'
+
+    def __init__(self, blob, backend):
+        self.blob = blob
+
+    def execute(self, path):
+        with open(path, 'rb') as fp:
+            text = fp.read().decode('utf8')
+        if not text.strip():
+            raise ValueError('Empty text')
+        self.blob.model.info = {'words': len(text.split())}
+
+
+class BlobTransformQueueTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(BlobTransformQueueTest, self).app_settings()
+        settings['transform_queue.url'] = 'redis://localhost:6379/1'
+        settings['transform_queue.name'] = 'unittest-transforms'
+        return settings
+
+    def setUp(self):
+        super(BlobTransformQueueTest, self).setUp()
+        self.app.registry.registerUtility(
+            WordCountTransform, IBlobTransform, 'text/plain')
+        self.queue = self.app.registry['transform_queue']
+        self.queue.empty()
+        tools.WORKER_REGISTRY = self.app.registry
+
+    def upload_blob(self, headers, content):
+        out = self.api.post_json('/api/v1/blob/records',
+                                 {'name': 'test.txt',
+                                  'bytes': len(content),
+                                  'format': 'text/plain'},
+                                 headers=headers,
+                                 status=201)
+        upload_headers = headers.copy()
+        upload_headers['Content-Type'] = 'text/plain'
+        self.api.put(out.json['upload_url'],
+                     content,
+                     headers=upload_headers,
+                     status=200)
+        return out.json['id']
+
+    def test_transforms_are_run_by_the_worker(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        blob_id = self.upload_blob(headers, b'This is a test!')
+        out = self.api.put('/api/v1/blob/records/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        assert out.json['transform_status'] == 'queued'
+        assert not out.json['finalized']
+        assert self.queue.count == 1
+        rq.SimpleWorker([self.queue],
+                        connection=self.queue.connection).work(burst=True)
+        out = self.api.get('/api/v1/blob/transform/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        assert out.json['transform_status'] == 'done'
+        assert out.json['transform_name'] == 'WordCount 1.0'
+        assert out.json['finalized'] is True
+
+    def test_failed_transforms_are_marked(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        blob_id = self.upload_blob(headers, b' ')
+        self.api.post('/api/v1/blob/transform/%s' % blob_id,
+                      headers=headers,
+                      status=200)
+        rq.SimpleWorker([self.queue],
+                        connection=self.queue.connection).work(burst=True)
+        out = self.api.get('/api/v1/blob/transform/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        assert out.json['transform_status'] == 'failed'
+        assert out.json['finalized'] is False
+
+    def test_failed_enqueue_marks_the_transform_failed(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        blob_id = self.upload_blob(headers, b'This is a test!')
+
+        def enqueue(*args, **kwargs):
+            raise redis.ConnectionError('Connection refused')
+
+        self.queue.enqueue = enqueue
+        out = self.api.put('/api/v1/blob/records/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        assert out.json['transform_status'] == 'queued'
+        out = self.api.get('/api/v1/blob/transform/%s' % blob_id,
+                           headers=headers,
+                           status=200)
+        assert out.json['transform_status'] == 'failed'
+        assert out.json['finalized'] is False
+
+    def test_upgrade_adds_the_transform_status_column(self):
+        self.app.registry['engine'].execute(
+            'ALTER TABLE unittest.blobs DROP transform_status')
+        session = self.storage.make_session(namespace='unittest')
+        assert tools.upgrade_repository(session, 'unittest') == [
+            'blobs.transform_status']
+        transaction.commit()
+        session = self.storage.make_session(namespace='unittest')
+        assert tools.upgrade_repository(session, 'unittest') == []
+        transaction.commit()
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.upload_blob(headers, b'This is a test!')
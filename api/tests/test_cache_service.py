@@ -1,4 +1,17 @@
-from idris.services.cache import cache_factory
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from idris.services.cache import (cache_factory,
+                                  CacheCodec,
+                                  MemoryCache,
+                                  GENERATIONS,
+                                  MEMORY_LOCKS,
+                                  msgpack)
+from idris.services.download_counter import download_counter_factory
 
 from core import BaseTest
 
@@ -22,7 +35,7 @@ class CacheServiceTest(BaseTest):
         assert self.cache.delete('foo')
         assert self.cache.get('foo') is None
 
-        assert self.cache.flush() == 1
+        assert self.cache.flush()
         assert self.cache.get('hello') is None
 
     def test_multi_tenancy(self):
@@ -31,7 +44,240 @@ class CacheServiceTest(BaseTest):
         assert cache_x.set('hello', 'x world')
         assert cache_y.set('hello', 'y world')
         assert cache_x.get('hello') == b'x world'
-        assert cache_x.flush() == 1
+        assert cache_x.flush()
         assert cache_x.get('hello') is None
         assert cache_y.get('hello') == b'y world'
-        assert cache_y.flush() == 1
+        assert cache_y.flush()
+
+    def test_flush_starts_a_new_generation(self):
+        generation = self.cache.generation()
+        assert self.cache.set('hello', 'world')
+        old_key = 'idris-eur-unittest:mc:%s:hello' % generation
+        assert self.cache._client.get(old_key) == b'world'
+        assert self.cache.flush()
+        assert self.cache.generation() == generation + 1
+        assert self.cache.get('hello') is None
+        # the old key is not removed, but it will expire
+        assert self.cache._client.ttl(old_key) > 0
+        # other processes pick up the new generation
+        GENERATIONS.clear()
+        assert self.cache.generation() == generation + 1
+
+    def test_services_share_the_redis_pool(self):
+        pool = self.app.registry['redis_pool']
+        stats = pool.stats()
+        cache_x = cache_factory(self.app.registry, 'x')
+        downloads = download_counter_factory(self.app.registry, 'x')
+        assert cache_x._client.connection_pool is pool
+        assert downloads._client.connection_pool is pool
+        cache_x.set('hello', 'x world')
+        cache_x.flush()
+        new_stats = pool.stats()
+        assert new_stats['checkouts'] > stats['checkouts']
+        assert new_stats['created'] <= stats['created'] + 1
+        assert new_stats['in_use'] == stats['in_use']
+        out = self.api.get('/debug_db')
+        assert out.text.splitlines()[-1].startswith('redis: ')
+
+
+    def test_get_or_compute_is_single_flight(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.3)
+            return {'rendered': len(calls)}
+
+        caches = [cache_factory(self.app.registry, 'unittest')
+                  for i in range(5)]
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(
+                lambda cache: cache.get_or_compute('course:1@2', compute, 60),
+                caches))
+        assert calls == [1]
+        assert results == [{'rendered': 1}] * 5
+        assert self.cache.get_object('course:1@2') == {'rendered': 1}
+        assert self.cache.get('lock:course:1@2') is None
+        self.cache.delete('course:1@2')
+
+    def test_get_or_compute_stops_waiting_for_slow_workers(self):
+        self.cache.wait_timeout = 0.2
+        self.cache.set('lock:course:1@3', 'other-worker')
+        assert self.cache.get_or_compute('course:1@3', lambda: 'mine') == 'mine'
+        self.cache.delete('lock:course:1@3')
+
+
+class TwoTierCacheServiceTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(TwoTierCacheServiceTest, self).app_settings()
+        settings['cache.l1_size'] = '2'
+        return settings
+
+    def setUp(self):
+        super(TwoTierCacheServiceTest, self).setUp()
+        self.cache = cache_factory(self.app.registry, 'unittest')
+        self.l1 = self.app.registry['cache_l1']
+        self.cache.flush()
+
+    def test_objects_are_kept_in_process(self):
+        value = {'title': 'Course X', 'toc_items': {'1': {}}}
+        assert self.cache.set_object('course:1@1', value, 60)
+        assert self.cache.get('course:1@1') == (
+            b'\xc0{"title": "Course X", "toc_items": {"1": {}}}')
+        # the same object is returned, without json decoding
+        assert self.cache.get_object('course:1@1') is value
+        other_cache = cache_factory(self.app.registry, 'x')
+        assert other_cache.get_object('course:1@1') is None
+        # an L1 miss is loaded from redis and kept in process
+        self.l1.clear()
+        value = self.cache.get_object('course:1@1')
+        assert value == {'title': 'Course X', 'toc_items': {'1': {}}}
+        assert self.cache.get_object('course:1@1') is value
+        self.cache.delete('course:1@1')
+        assert self.cache.get_object('course:1@1') is None
+
+    def test_l1_is_bounded(self):
+        for revision in range(3):
+            self.cache.set_object('course:1@%s' % revision, revision)
+        assert len(self.l1) == 2
+        assert self.cache.get_object('course:1@0') == 0
+        assert self.cache.flush()
+        assert len(self.l1) == 0
+
+
+class CacheCodecTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(CacheCodecTest, self).app_settings()
+        settings['cache.compression'] = 'zlib'
+        settings['cache.compression_threshold'] = '100'
+        return settings
+
+    def setUp(self):
+        super(CacheCodecTest, self).setUp()
+        self.cache = cache_factory(self.app.registry, 'unittest')
+        self.cache.flush()
+
+    def test_compressed_objects(self):
+        value = {'toc_items': dict((str(i), {'title': 'Material %s' % i})
+                                   for i in range(100))}
+        assert self.cache.set_object('course:1@1', value)
+        raw = self.cache.get('course:1@1')
+        assert raw[0] == 0xC1
+        assert len(raw) < len(json.dumps(value)) / 2
+        assert self.cache.get_object('course:1@1') == value
+        # small objects are not compressed
+        self.cache.set_object('small', {'a': 1})
+        assert self.cache.get('small') == b'\xc0{"a": 1}'
+        assert self.cache.get_object('small') == {'a': 1}
+        assert self.cache.key_sizes() == [('course:1@1', len(raw)),
+                                          ('small', 9)]
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/debug_cache', headers=headers)
+        assert out.text.splitlines()[1] == 'small: 9'
+        self.cache.flush()
+        assert self.cache.key_sizes() == []
+
+    def test_plain_json_entries_can_be_read(self):
+        self.cache.set('course:1@1', json.dumps({'a': 1}).encode('utf8'))
+        assert self.cache.get_object('course:1@1') == {'a': 1}
+        self.cache.flush()
+
+    @pytest.mark.skipif(msgpack is None, reason='msgpack is not installed')
+    def test_msgpack_codec(self):
+        codec = CacheCodec(serializer='msgpack', compression='zlib')
+        data = codec.encode({1: 'x', 'b': [1, 2]})
+        assert data[0] == 0xC4
+        assert codec.decode(data) == {1: 'x', 'b': [1, 2]}
+        # json entries are still readable
+        assert codec.decode(CacheCodec().encode({'a': 1})) == {'a': 1}
+
+    def test_unknown_codec(self):
+        with pytest.raises(ValueError):
+            CacheCodec(compression='bzip2')
+
+
+class MemoryCacheServiceTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(MemoryCacheServiceTest, self).app_settings()
+        settings['cache.url'] = 'memory://'
+        settings['cache.memory_max_size'] = '3'
+        return settings
+
+    def setUp(self):
+        super(MemoryCacheServiceTest, self).setUp()
+        self.cache = cache_factory(self.app.registry, 'unittest')
+        self.cache.flush()
+
+    def test_set_get(self):
+        assert isinstance(self.cache, MemoryCache)
+        assert self.cache.set('hello', 'world')
+        assert self.cache.get('hello') == b'world'
+        assert self.cache.set('hello', 1)
+        assert self.cache.get('hello') == b'1'
+        assert self.cache.set('foo', 'bar', 1)
+        assert self.cache.delete('foo') == 1
+        assert self.cache.get('foo') is None
+        other_cache = cache_factory(self.app.registry, 'x')
+        assert other_cache.get('hello') is None
+        assert self.cache.flush()
+        assert self.cache.get('hello') is None
+
+    def test_objects(self):
+        assert self.cache.set_object('course:1@1', {'a': 1})
+        assert self.cache.get_object('course:1@1') == {'a': 1}
+        assert self.cache.key_sizes() == [('course:1@1', 9)]
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.2)
+            return {'rendered': len(calls)}
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(executor.map(
+                lambda i: self.cache.get_or_compute('course:1@2', compute),
+                range(3)))
+        assert results == [{'rendered': 1}] * 3
+        # the cache is bounded
+        for i in range(3):
+            self.cache.set('key-%s' % i, i)
+        assert self.cache.get('course:1@1') is None
+        assert self.cache.get('key-0') == b'0'
+
+    def test_get_or_compute_keeps_the_lock_of_waiting_callers(self):
+        calls = []
+        computing = threading.Event()
+        done = threading.Event()
+
+        def compute():
+            calls.append(1)
+            if len(calls) == 1:
+                time.sleep(0.1)
+                raise IOError('Service Unavailable')
+            computing.set()
+            done.wait(1)
+            return {'rendered': len(calls)}
+
+        def get(i):
+            try:
+                return self.cache.get_or_compute('course:1@4', compute)
+            except IOError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            # the first caller fails, the second computes while a third
+            # caller arrives, which has to wait for the second one
+            first = executor.submit(get, 1)
+            time.sleep(0.05)
+            second = executor.submit(get, 2)
+            computing.wait(1)
+            third = executor.submit(get, 3)
+            time.sleep(0.05)
+            done.set()
+            results = [first.result(), second.result(), third.result()]
+        assert results == [None, {'rendered': 2}, {'rendered': 2}]
+        assert len(calls) == 2
+        assert MEMORY_LOCKS == {}
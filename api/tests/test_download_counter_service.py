@@ -1,5 +1,14 @@
+import os
+import time
 import datetime
-from idris.services.download_counter import download_counter_factory
+from concurrent.futures import ThreadPoolExecutor
+import redis
+from idris.services.download_counter import (download_counter_factory,
+                                             flush_download_buffers,
+                                             DownloadBuffer,
+                                             MemoryDownloadCounter,
+                                             ROTATED)
+from idris.utils import HyperLogLog
 
 from core import BaseTest
 
@@ -62,6 +71,8 @@ class DownloadCounterServiceTest(BaseTest):
         # downloads of today should drop off,
         # the unique download  from user 'you' is also gone
         future_date = when + datetime.timedelta(days=30)
+        # the daily rotation removes users from the unique window
+        self.downloads.rotate_hll(future_date)
         self.downloads.count(12345, 'me', future_date)
         assert self.downloads.get_total_counts([12345]) == [2]
         assert self.downloads.get_unique_counts([12345]) == [1]
@@ -77,3 +88,180 @@ class DownloadCounterServiceTest(BaseTest):
             assert self.downloads.get_unique_counts([expression_id]) == [2]
         assert self.downloads.get_total_counts(['repo']) == [8]
         assert self.downloads.get_unique_counts(['repo']) == [2]
+
+    def test_concurrent_downloads_are_counted_atomically(self):
+        users = ['user-%s' % i for i in range(10)]
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(
+                lambda user: [self.downloads.count(1, user)
+                              for i in range(5)],
+                users))
+        assert self.downloads.get_total_counts([1, 'repo']) == [50, 50]
+        assert self.downloads.get_unique_counts([1, 'repo']) == [10, 10]
+        history = self.downloads.history(1)
+        assert sum(v for k, v in history.items() if k.startswith('t-')) == 50
+
+    def test_rotate_hll(self):
+        when = datetime.datetime.utcnow()
+        client = self.downloads._client
+        hll_key = self.downloads._prefix + ':hll'
+        self.downloads.count(1, 'me', when)
+        self.downloads.count(1, 'you', when + datetime.timedelta(days=10))
+        # the hll holds the users of material 1 and of the repository
+        assert client.pfcount(hll_key) == 4
+        self.downloads.rotate_hll(when + datetime.timedelta(days=29))
+        assert client.pfcount(hll_key) == 4
+        self.downloads.rotate_hll(when + datetime.timedelta(days=30))
+        assert client.pfcount(hll_key) == 2
+        self.downloads.rotate_hll(when + datetime.timedelta(days=40))
+        assert client.pfcount(hll_key) == 0
+        assert client.exists(self.downloads._prefix + ':hll-merge') == 0
+
+    def test_first_download_of_the_day_rotates_the_hll(self):
+        client = self.downloads._client
+        hll_key = self.downloads._prefix + ':hll'
+        ROTATED.clear()
+        # a user that downloaded more then 30 days ago
+        client.pfadd(hll_key, 'expired')
+        self.downloads.count(1, 'me')
+        assert client.pfcount(hll_key) == 2
+        # other processes do not rotate again today
+        ROTATED.clear()
+        client.pfadd(hll_key, 'expired')
+        self.downloads.count(1, 'you')
+        assert client.pfcount(hll_key) == 5
+
+
+class BufferedDownloadCounterTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(BufferedDownloadCounterTest, self).app_settings()
+        settings['download_counter.buffered'] = 'true'
+        settings['download_counter.buffer_interval'] = '60000'
+        settings['download_counter.buffer_size'] = '10'
+        return settings
+
+    def setUp(self):
+        super(BufferedDownloadCounterTest, self).setUp()
+        self.buffer = self.app.registry['download_buffer']
+        self.downloads = download_counter_factory(self.app.registry, 'unittest')
+        self.downloads.flush()
+
+    def test_downloads_are_coalesced_until_flushed(self):
+        self.downloads.count(1, 'me')
+        self.downloads.count(1, 'me')
+        self.downloads.count(1, 'you')
+        self.downloads.count(2, 'me')
+        assert len(self.buffer) == 4
+        assert self.downloads.get_total_counts([1, 2, 'repo']) == [0, 0, 0]
+        assert flush_download_buffers() == 4
+        assert len(self.buffer) == 0
+        assert self.downloads.get_total_counts([1, 2, 'repo']) == [3, 1, 4]
+        assert self.downloads.get_unique_counts([1, 2, 'repo']) == [2, 1, 2]
+        self.downloads.count(1, 'me')
+        self.buffer.flush()
+        assert self.downloads.get_total_counts([1, 'repo']) == [4, 5]
+        assert self.downloads.get_unique_counts([1, 'repo']) == [2, 2]
+
+    def test_partially_failed_flush_does_not_count_twice(self):
+        client = self.downloads._client
+        # counting expression 2 fails, its key is not a hash
+        client.set(self.downloads._prefix + ':2', 'broken')
+        self.downloads.count(1, 'me')
+        self.downloads.count(2, 'me')
+        assert self.buffer.flush() == 1
+        assert len(self.buffer) == 1
+        assert self.downloads.get_total_counts([1, 'repo']) == [1, 1]
+        client.delete(self.downloads._prefix + ':2')
+        assert self.buffer.flush() == 1
+        assert len(self.buffer) == 0
+        assert self.downloads.get_total_counts([1, 2, 'repo']) == [1, 1, 2]
+
+    def test_pending_downloads_are_capped_while_redis_is_down(self):
+        buffer = DownloadBuffer(max_size=2, max_pending=3)
+        buffer._pid = os.getpid()  # no background thread
+
+        def count_many(downloads):
+            raise redis.ConnectionError('Connection refused')
+
+        self.downloads.count_many = count_many
+        when = datetime.datetime(2019, 3, 1)
+        for day in range(5):
+            buffer.add(self.downloads, 1, 'me',
+                       when + datetime.timedelta(days=day))
+        assert buffer.flush() == 0
+        assert len(buffer) == 3
+        assert sorted(key[3] for key in buffer._downloads) == [
+            '2019-03-03', '2019-03-04', '2019-03-05']
+
+    def test_full_buffer_is_flushed_in_the_background(self):
+        for i in range(10):
+            self.downloads.count(1, 'user-%s' % i)
+        for i in range(20):
+            if self.downloads.get_total_counts([1]) == [10]:
+                break
+            time.sleep(0.1)
+        assert self.downloads.get_total_counts([1]) == [10]
+        assert self.downloads.get_unique_counts([1]) == [10]
+
+
+class MemoryDownloadCounterServiceTest(DownloadCounterServiceTest):
+
+    def app_settings(self):
+        settings = super(MemoryDownloadCounterServiceTest, self).app_settings()
+        settings['cache.url'] = 'memory://'
+        return settings
+
+    def test_memory_backend(self):
+        assert isinstance(self.downloads, MemoryDownloadCounter)
+
+    def test_rotate_hll(self):
+        when = datetime.datetime.utcnow()
+        self.downloads.count(1, 'me', when)
+        self.downloads.count(1, 'you', when + datetime.timedelta(days=10))
+        hll = lambda: self.downloads._get('hll').count()
+        assert hll() == 4
+        self.downloads.rotate_hll(when + datetime.timedelta(days=30))
+        assert hll() == 2
+        self.downloads.rotate_hll(when + datetime.timedelta(days=40))
+        assert hll() == 0
+        assert sorted(self.downloads._keys()) == [
+            '1', 'hll', 'hll-rotated-%s' % when.strftime('%Y-%m-%d'), 'repo']
+
+    def test_first_download_of_the_day_rotates_the_hll(self):
+        self.downloads._get('hll', HyperLogLog).add('expired')
+        self.downloads.count(1, 'me')
+        assert self.downloads._get('hll').count() == 2
+        self.downloads._get('hll').add('expired')
+        self.downloads.count(1, 'you')
+        assert self.downloads._get('hll').count() == 5
+
+    def test_expired_keys_are_purged_on_write(self):
+        when = datetime.datetime.utcnow()
+        self.downloads.count(1, 'me', when)
+        self.downloads._set('1', self.downloads._get('1'), ttl=0.01)
+        time.sleep(0.02)
+        self.downloads.count(2, 'me', when + datetime.timedelta(days=1))
+        assert '1' not in self.downloads._keys()
+
+
+class BoundedMemoryDownloadCounterServiceTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(
+            BoundedMemoryDownloadCounterServiceTest, self).app_settings()
+        settings['cache.url'] = 'memory://'
+        settings['download_counter.memory_max_size'] = '5'
+        return settings
+
+    def setUp(self):
+        super(BoundedMemoryDownloadCounterServiceTest, self).setUp()
+        self.downloads = download_counter_factory(self.app.registry, 'unittest')
+        self.downloads.flush()
+
+    def test_least_recently_used_keys_are_evicted(self):
+        for expression_id in range(10):
+            self.downloads.count(expression_id, 'me')
+        keys = self.downloads._keys()
+        assert len(keys) == 5
+        assert '9' in keys and '0' not in keys
@@ -0,0 +1,123 @@
+import datetime
+
+import pytest
+import transaction
+from sqlalchemy import exc
+
+from idris import tools
+from idris.models import DownloadStats
+from idris.services.download_counter import download_counter_factory
+from idris.services.download_stats import (rollup_downloads,
+                                           download_statistics)
+
+from test_course import BaseCourseTest
+
+
+class DownloadStatsServiceTest(BaseCourseTest):
+
+    def setUp(self):
+        super(DownloadStatsServiceTest, self).setUp()
+        self.downloads = download_counter_factory(self.app.registry, 'unittest')
+        self.downloads.flush()
+        self.session = self.storage.make_session(namespace='unittest')
+        self.today = datetime.datetime(2018, 12, 31)
+        self.yesterday = datetime.datetime(2018, 12, 30)
+
+    def count(self):
+        self.downloads.count(self.pub_id, 'me', self.yesterday)
+        self.downloads.count(self.pub_id, 'you', self.yesterday)
+        self.downloads.count(self.pub_id, 'me', self.today)
+        self.downloads.count(self.another_pub_id, 'me', self.today)
+
+    def test_rollup_downloads(self):
+        self.count()
+        assert rollup_downloads(self.session, self.downloads) == 2
+        transaction.commit()
+        rows = self.session.query(DownloadStats).order_by(
+            DownloadStats.date, DownloadStats.work_id).all()
+        assert [(r.work_id, r.date.day, r.total, r.unique) for r in rows] == [
+            (self.pub_id, 30, 2, 2),
+            (None, 30, 2, 2),
+            (self.pub_id, 31, 1, 0),
+            (self.another_pub_id, 31, 1, 1),
+            (None, 31, 2, 0)]
+        # rolling up again overwrites the existing days
+        self.downloads.count(self.pub_id, 'me', self.today)
+        rollup_downloads(self.session, self.downloads)
+        transaction.commit()
+        assert self.session.query(DownloadStats).count() == 5
+        assert self.session.query(DownloadStats).filter(
+            DownloadStats.work_id == self.pub_id,
+            DownloadStats.date == self.today.date()).one().total == 2
+
+    def test_overlapping_rollups_do_not_duplicate_rows(self):
+        self.count()
+        # a row written by another rollup run
+        self.session.add(DownloadStats(work_id=None,
+                                       date=self.today.date(),
+                                       total=1,
+                                       unique=1))
+        self.session.flush()
+        rollup_downloads(self.session, self.downloads)
+        transaction.commit()
+        assert self.session.query(DownloadStats).count() == 5
+        assert self.session.query(DownloadStats).filter(
+            DownloadStats.work_id == None,
+            DownloadStats.date == self.today.date()).one().total == 2
+        self.session.add(DownloadStats(work_id=None,
+                                       date=self.today.date(),
+                                       total=1,
+                                       unique=1))
+        with pytest.raises(exc.IntegrityError):
+            self.session.flush()
+        transaction.abort()
+
+    def test_download_statistics(self):
+        self.count()
+        rollup_downloads(self.session, self.downloads)
+        transaction.commit()
+        start, end = datetime.date(2018, 1, 1), datetime.date(2018, 12, 31)
+        assert download_statistics(
+            self.session, start, end, group_by='work') == [
+                {'id': self.pub_id, 'period': None, 'total': 3, 'unique': 2},
+                {'id': self.another_pub_id, 'period': None,
+                 'total': 1, 'unique': 1}]
+        out = download_statistics(
+            self.session, start, end, group_by='work', period='day',
+            ids=[self.another_pub_id])
+        assert out == [{'id': self.another_pub_id, 'period': '2018-12-31',
+                        'total': 1, 'unique': 1}]
+        # only the first publication is part of the course
+        assert download_statistics(
+            self.session, start, end, group_by='course') == [
+                {'id': self.course_id, 'period': None,
+                 'total': 3, 'unique': 2}]
+        # the course is published by the faculty
+        assert download_statistics(
+            self.session, start, end, group_by='group', period='year') == [
+                {'id': self.corp_id, 'period': '2018',
+                 'total': 3, 'unique': 2}]
+        assert download_statistics(
+            self.session, start, end, group_by='repository',
+            period='month') == [
+                {'id': None, 'period': '2018-12', 'total': 4, 'unique': 2}]
+        assert download_statistics(
+            self.session, start, datetime.date(2018, 12, 30),
+            group_by='repository')[0]['total'] == 2
+
+    def test_upgrade_adds_the_unique_index(self):
+        engine = self.app.registry['engine']
+        engine.execute('DROP INDEX unittest.ix_download_stats_work_id_date')
+        # rows of two overlapping rollups, before the index existed
+        for total in (1, 2):
+            engine.execute(
+                'INSERT INTO unittest.download_stats '
+                '(id, date, total, "unique") VALUES '
+                "(nextval('unittest.download_stats_id_seq'), '2018-12-31', "
+                '%s, %s)' % (total, total))
+        assert tools.upgrade_download_stats(self.session, 'unittest') is True
+        transaction.commit()
+        session = self.storage.make_session(namespace='unittest')
+        assert tools.upgrade_download_stats(session, 'unittest') is False
+        assert [(r.total, r.unique) for r in session.query(DownloadStats)] == [
+            (2, 2)]
@@ -0,0 +1,335 @@
+import time
+import sqlite3
+
+import pytest
+import transaction
+from sqlalchemy import exc
+
+from idris.pool import MeteredQueuePool, TenantBudget, tenant_pool_limits
+from idris.storage import (REPOSITORY_CACHE,
+                           TYPE_CONFIG_CACHE,
+                           repository_change_listener)
+
+from core import BaseTest
+
+
+class RepositoryCacheTest(BaseTest):
+
+    def test_repository_is_cached_by_vhost(self):
+        # creating the repository in setUp removes stale entries
+        assert REPOSITORY_CACHE.get('unittest.localhost') is None
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.get('/api/v1/schemes/settings', headers=headers)
+        info = REPOSITORY_CACHE.get('unittest.localhost')
+        assert info['namespace'] == 'unittest'
+        assert info['app'] == 'base'
+        assert 'config_revision' in info
+        assert 'title' in info['settings']
+
+    def test_cache_is_invalidated_on_repository_changes(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/api/v1/schemes/settings', headers=headers)
+        revision = REPOSITORY_CACHE.get(
+            'unittest.localhost')['config_revision']
+        settings = out.json
+        settings['title'] = 'Cached Repository'
+        self.api.put_json('/api/v1/schemes/settings',
+                          settings,
+                          headers=headers)
+        assert REPOSITORY_CACHE.get('unittest.localhost') is None
+        out = self.api.get('/api/v1/schemes/settings', headers=headers)
+        assert out.json['title'] == 'Cached Repository'
+        info = REPOSITORY_CACHE.get('unittest.localhost')
+        assert info['config_revision'] > revision
+
+    def test_cache_is_invalidated_on_drop_repository(self):
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+        assert REPOSITORY_CACHE.get('unittest.localhost') is not None
+        self.storage.drop_repository(self.session, 'unittest')
+        transaction.commit()
+        assert REPOSITORY_CACHE.get('unittest.localhost') is None
+
+
+class TypeConfigCacheTest(BaseTest):
+
+    def test_only_latest_revision_is_cached(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.get('/api/v1/client', headers=headers)
+        revision, config = TYPE_CONFIG_CACHE.get('unittest')
+        assert 'group_type' in config
+        out = self.api.get('/api/v1/schemes/types/group', headers=headers)
+        self.api.put_json('/api/v1/schemes/types/group',
+                          out.json,
+                          headers=headers)
+        self.api.get('/api/v1/client', headers=headers)
+        new_revision, config = TYPE_CONFIG_CACHE.get('unittest')
+        assert new_revision > revision
+        assert 'group_type' in config
+
+    def test_changes_are_published_to_all_processes(self):
+        listener = repository_change_listener(self.app.registry)
+        listener.start()
+        REPOSITORY_CACHE.set('unittest.localhost', {'namespace': 'unittest'})
+        TYPE_CONFIG_CACHE.set('unittest', (1, {}))
+        # wait until the listener thread is subscribed
+        for i in range(20):
+            if listener.publish('unittest'):
+                break
+            time.sleep(0.1)
+        for i in range(20):
+            if 'unittest' not in TYPE_CONFIG_CACHE:
+                break
+            time.sleep(0.1)
+        assert 'unittest' not in TYPE_CONFIG_CACHE
+        assert REPOSITORY_CACHE.get('unittest.localhost') is None
+
+
+class PinnedTenantConnectionsTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(PinnedTenantConnectionsTest, self).app_settings()
+        settings['idris.pin_tenant_connections'] = 'true'
+        return settings
+
+    def test_requests_use_tenant_engine(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        out = self.api.get('/api/v1/schemes/types/group', headers=headers)
+        assert 'organisation' in [v['key'] for v in out.json['values']]
+        tenant_engines = self.app.registry['tenant_engines']
+        assert 'unittest' in tenant_engines
+
+    def test_tenant_sessions_have_search_path_pinned(self):
+        tenant_engines = self.app.registry['tenant_engines']
+        session = self.storage.make_session(namespace='unittest')
+        assert session.bind is tenant_engines.get('unittest')
+        assert session.execute(
+            'SHOW search_path').scalar() == 'unittest,public'
+
+
+class TenantPoolTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(TenantPoolTest, self).app_settings()
+        settings['idris.pin_tenant_connections'] = 'true'
+        settings['idris.tenant_pool.min_size'] = '2'
+        settings['idris.tenant_pool.max_size'] = '4'
+        settings['idris.tenant_pool.unittest.max_size'] = '3'
+        return settings
+
+    def test_tenant_pool_limits(self):
+        pool = self.app.registry['tenant_engines'].get('unittest').pool
+        assert pool.size() == 2
+        assert pool.stats()['max_overflow'] == 1
+        pool = self.app.registry['tenant_engines'].get('other').pool
+        assert pool.stats()['max_overflow'] == 2
+
+    def test_pool_numbers_in_debug_view(self):
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+        out = self.api.get('/debug_db')
+        lines = out.text.splitlines()
+        assert lines[0].startswith('default: ')
+        assert lines[1].startswith('unittest: ')
+        assert 'checkouts=1 ' in lines[1]
+        assert 'timeouts=0 ' in lines[1]
+
+    def test_pool_metrics_record_queueing_and_timeouts(self):
+        pool = MeteredQueuePool(lambda: sqlite3.connect(':memory:'),
+                                pool_size=1,
+                                max_overflow=0,
+                                timeout=0.1)
+        conn = pool.connect()
+        with pytest.raises(exc.TimeoutError):
+            pool.connect()
+        conn.close()
+        pool.connect().close()
+        stats = pool.stats()
+        assert stats['checkouts'] == 3
+        assert stats['queued'] == 1
+        assert stats['timeouts'] == 1
+        assert stats['waiting'] == 0
+        assert stats['max_wait_time'] >= 0.1
+
+
+class TenantBudgetTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(TenantBudgetTest, self).app_settings()
+        settings['idris.pin_tenant_connections'] = 'true'
+        settings['idris.tenant_pool.total'] = '3'
+        settings['idris.tenant_pool.max_size'] = '2'
+        settings['idris.tenant_pool.timeout'] = '1'
+        return settings
+
+    def test_default_tenant_pool_is_small(self):
+        pool = self.app.registry['tenant_engines'].get('other').pool
+        assert pool.size() == 1
+        assert pool.stats()['max_overflow'] == 1
+
+    def test_tenants_share_the_connection_budget(self):
+        tenant_engines = self.app.registry['tenant_engines']
+        connections = [tenant_engines.get('unittest').pool.connect(),
+                       tenant_engines.get('unittest').pool.connect(),
+                       tenant_engines.get('other').pool.connect()]
+        budget = self.app.registry['tenant_budget']
+        assert budget.stats()['in_use'] == 3
+        # the other tenant has room in its own pool, but not in the budget
+        other_pool = tenant_engines.get('other').pool
+        with pytest.raises(exc.TimeoutError):
+            other_pool.connect()
+        assert other_pool.stats()['timeouts'] == 1
+        connections.pop(0).close()
+        connections.append(other_pool.connect())
+        for connection in connections:
+            connection.close()
+        assert budget.stats()['in_use'] == 0
+
+    def test_shared_pool_is_divided_between_tenants(self):
+        budget = TenantBudget(3, tenant_limits=lambda namespace: (1, 2))
+        budget.acquire('unittest', 0.1)
+        budget.acquire('unittest', 0.1)
+        with pytest.raises(exc.TimeoutError):
+            budget.acquire('unittest', 0.1)
+        budget.acquire('other', 0.1)
+        with pytest.raises(exc.TimeoutError):
+            budget.acquire('other', 0.1)
+        assert budget.stats() == {'total': 3,
+                                  'reserved': 2,
+                                  'in_use': 3,
+                                  'burst': 1,
+                                  'tenants': 2,
+                                  'timeouts': 2}
+        budget.release('unittest')
+        budget.acquire('other', 0.1)
+
+    def test_tenants_keep_their_reserved_connections(self):
+        budget = TenantBudget(14, tenant_limits=lambda namespace: (1, 7))
+        for i in range(7):
+            budget.acquire('a', 0)
+            budget.acquire('b', 0)
+        # the burst pool is taken, tenant c gets the first connection
+        # that is released, the others can not burst above their minimum
+        with pytest.raises(exc.TimeoutError):
+            budget.acquire('c', 0)
+        budget.release('a')
+        with pytest.raises(exc.TimeoutError):
+            budget.acquire('a', 0)
+        budget.acquire('c', 0)
+        assert budget.stats()['reserved'] == 3
+        assert budget.stats()['in_use'] == 14
+
+    def test_requests_take_from_the_tenant_budget(self):
+        settings = self.app.registry.settings
+        assert tenant_pool_limits(settings, 'unittest') == (1, 2, 1)
+        budget = self.app.registry['tenant_budget']
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+        assert budget.stats()['in_use'] == 0
+        assert 'budget: burst=0 in_use=0 ' in self.api.get('/debug_db').text
+
+
+class SharedPoolBudgetTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(SharedPoolBudgetTest, self).app_settings()
+        settings['idris.tenant_pool.max_size'] = '1'
+        settings['idris.tenant_pool.timeout'] = '0'
+        return settings
+
+    def test_busy_tenant_can_not_take_the_shared_pool(self):
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+        budget = self.app.registry['tenant_budget']
+        assert budget.stats()['in_use'] == 0
+        # another request of the tenant holds its only connection
+        budget.acquire('unittest', 0)
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'},
+                           status=503)
+        budget.release('unittest')
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+
+
+class LazySessionTest(BaseTest):
+
+    def checkouts(self):
+        return self.app.registry['engine'].pool.stats()['checkouts']
+
+    def test_tenantless_routes_do_not_use_the_database(self):
+        REPOSITORY_CACHE.clear()
+        checkouts = self.checkouts()
+        self.api.get('/_live')
+        self.api.get('/_ready')
+        self.api.get('/api', status=302)
+        self.api.get('/api/index.html')
+        assert self.checkouts() == checkouts
+        assert REPOSITORY_CACHE.get('unittest.localhost') is None
+
+    def test_connection_is_checked_out_on_first_query(self):
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+        checkouts = self.checkouts()
+        # the repository is cached, and the debug view does not query
+        self.api.get('/debug_repo')
+        assert self.checkouts() == checkouts
+        self.api.post_json('/api/v1/auth/login',
+                           {'user': 'admin', 'password': 'admin'})
+        assert self.checkouts() == checkouts + 1
+
+
+class ReplicaRoutingTest(BaseTest):
+
+    def app_settings(self):
+        settings = super(ReplicaRoutingTest, self).app_settings()
+        settings['sqlalchemy.replica.url'] = settings['sqlalchemy.url']
+        settings['sqlalchemy.replica.pool_size'] = '2'
+        return settings
+
+    def checkouts(self, engine):
+        return self.app.registry[engine].pool.stats()['checkouts']
+
+    def test_read_only_routes_use_the_replica(self):
+        assert self.app.registry['replica_engine'].pool.size() == 2
+        assert self.app.registry['engine'].pool.size() == 5
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.reset()
+        replica_checkouts = self.checkouts('replica_engine')
+        self.api.get('/api/v1/work/listing', headers=headers)
+        assert self.checkouts('replica_engine') == replica_checkouts + 1
+        # other routes keep using the primary
+        self.api.get('/api/v1/schemes/settings', headers=headers)
+        assert self.checkouts('replica_engine') == replica_checkouts + 1
+
+    def test_writes_make_reads_sticky_to_the_primary(self):
+        out = self.api.post_json('/api/v1/auth/login',
+                                 {'user': 'admin', 'password': 'admin'})
+        assert 'idris_primary=1' in out.headers['Set-Cookie']
+        headers = dict(Authorization='Bearer %s' % out.json['token'])
+        replica_checkouts = self.checkouts('replica_engine')
+        self.api.get('/api/v1/work/listing', headers=headers)
+        assert self.checkouts('replica_engine') == replica_checkouts
+        self.api.reset()
+        self.api.get('/api/v1/work/listing', headers=headers)
+        assert self.checkouts('replica_engine') == replica_checkouts + 1
+
+    def test_replica_reads_do_not_take_from_the_tenant_budget(self):
+        headers = dict(Authorization='Bearer %s' % self.admin_token())
+        self.api.reset()
+        budget = self.app.registry['tenant_budget']
+        held = 0
+        while True:
+            try:
+                budget.acquire('unittest', 0)
+            except exc.TimeoutError:
+                break
+            held += 1
+        self.api.get('/api/v1/work/listing', headers=headers)
+        self.api.get('/api/v1/schemes/settings', headers=headers, status=503)
+        for i in range(held):
+            budget.release('unittest')
+
+    def test_replica_pool_in_debug_view(self):
+        out = self.api.get('/debug_db')
+        assert out.text.splitlines()[1].startswith('replica: ')